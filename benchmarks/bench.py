@@ -0,0 +1,266 @@
+"""Offline benchmarks, results are printed as JSON to compare runs.
+
+Everything runs against a local HTTP server with synthetic media and fake
+extractors for playlists of any size, nothing goes out to the internet.
+Run it from the repository root:
+
+    python benchmarks/bench.py --playlist-size 50 --output before.json
+"""
+import argparse
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+from urllib.request import urlopen
+from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), HERE]
+
+from youtube_dl_server import processes  # noqa: E402
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class QuietWSGIHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_media(root, size):
+    for name in ('video.mp4', 'audio.m4a'):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(os.urandom(size))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=root))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[int(len(samples) * 0.95)],
+        'max': samples[-1],
+    }
+
+
+def wait_for(condition, timeout, interval=0.005):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(interval)
+
+
+def bench_end_to_end(app, playlist_size, timeout):
+    """Tasks/s from submitting a playlist until all its jobs are done"""
+    from youtube_dl_server.jobs import QUEUED, CLAIMED
+    from youtube_dl_server.task import Task
+
+    def pending():
+        n, = app.queue.db.execute(
+            'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, CLAIMED)
+        ).fetchone()
+        return n
+
+    started = time.monotonic()
+    app.queue.put(Task('fake://playlist/e2e/{}'.format(playlist_size)))
+    wait_for(lambda: pending() == 0, timeout, interval=0.05)
+    elapsed = time.monotonic() - started
+    jobs, = app.queue.db.execute('SELECT COUNT(*) FROM jobs').fetchone()
+    return {
+        'playlist_size': playlist_size,
+        'jobs': jobs,
+        'seconds': elapsed,
+        'tasks_per_second': jobs / elapsed,
+    }
+
+
+def bench_state(app, sizes, requests):
+    """Latency of a full /state, of /state?since= with a few changes and of a page
+    of the downloading entries, by number of entries
+    """
+    from youtube_dl_server.server import Server
+    server = make_server('127.0.0.1', 0, app, server_class=Server, handler_class=QuietWSGIHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}/state'.format(server.server_port)
+    results = []
+    for size in sizes:
+        for url in list(app.state.entries):
+            app.state.delete(url)
+        for i in range(size):
+            app.state.update('fake://video/state-{}'.format(i), {
+                'status': 'downloading', 'title': 'Video {}'.format(i), 'thumbnail': '',
+                'downloaded_bytes': i, 'total_bytes': size, '_percent_str': '50.0%', 'speed': 1000.0,
+            })
+        since = app.state.version - 10
+        full, changes, pages, body = [], [], [], 0
+        for _ in range(requests):
+            t = time.perf_counter()
+            body = len(urlopen(base).read())
+            full.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            urlopen('{}?since={}'.format(base, since)).read()
+            changes.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            urlopen('{}?status=downloading&limit=50&cursor={}'.format(base, size // 2)).read()
+            pages.append(time.perf_counter() - t)
+        results.append({
+            'entries': size,
+            'full_bytes': body,
+            'full_seconds': percentiles(full),
+            'since_seconds': percentiles(changes),
+            'page_seconds': percentiles(pages),
+        })
+    server.shutdown()
+    return results
+
+
+def bench_inform(app, ticks):
+    """Seconds per progress hook call of a worker, with and without coalescing"""
+    from youtube_dl_server.task import Task
+    from youtube_dl_server.youtube import YTWorker
+    results = []
+    for interval in (0, app.inform_interval):
+        events = processes.Queue()
+        w = YTWorker(
+            queue=app.queue, events=events, busy=processes.Value('b', False), counters=processes.Array('L', 2),
+            cache=app.cache, archive=app.archive, inform_interval=interval,
+        )
+        w.task = Task('fake://video/inform', id=0)
+        w._claimed = (w.task, time.monotonic())
+        started = time.perf_counter()
+        for i in range(ticks):
+            w.inform({
+                'status': 'downloading', 'downloaded_bytes': i, 'total_bytes': ticks,
+                'speed': 1000.0, 'eta': ticks - i, '_percent_str': '{:.1f}%'.format(100 * i / ticks),
+                'filename': 'video.mp4', 'tmpfilename': 'video.mp4.part',
+            })
+        elapsed = time.perf_counter() - started
+        w.flush()
+        results.append({
+            'inform_interval': interval,
+            'ticks': ticks,
+            'seconds_per_tick': elapsed / ticks,
+            'sent': w.counters[0],
+            'merged': w.counters[1],
+        })
+        # nobody reads them, do not wait for them to be written at exit
+        events.cancel_join_thread()
+        events.close()
+    return results
+
+
+def bench_startup(rounds):
+    """Seconds a new interpreter takes to import the server and make its app"""
+    code = 'import time; t = time.monotonic(); from youtube_dl_server.server import app; print(time.monotonic() - t)'
+    samples = []
+    for _ in range(rounds):
+        out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        samples.append(float(out.splitlines()[-1]))
+    return percentiles(samples)
+
+
+def bench_respawn(app, rounds, timeout):
+    """Seconds from a downloader dying until its replacement claimed a waiting job"""
+    from youtube_dl_server.jobs import CLAIMED
+    from youtube_dl_server.task import Task
+    samples = []
+    for i in range(rounds):
+        # keep the supervisor of the app out of the way, we want to see one respawn
+        for w in app.get_running_workers():
+            w.terminate()
+            w.join()
+        task = Task('fake://video/respawn-{}'.format(i), info={'id': 'respawn-{}'.format(i), 'title': 'x'})
+        app.queue.put(task)
+        started = time.monotonic()
+        app.ensure_workers()
+
+        def claimed():
+            status, = app.queue.db.execute('SELECT status FROM jobs WHERE id = ?', (task.id,)).fetchone()
+            return status == CLAIMED
+        wait_for(claimed, timeout)
+        samples.append(time.monotonic() - started)
+        wait_for(lambda: not app.get_busy_workers(), timeout, interval=0.05)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--playlist-size', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--media-size', type=int, default=256 * 1024, help='bytes of every stream')
+    parser.add_argument('--state-sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--state-requests', type=int, default=20)
+    parser.add_argument('--ticks', type=int, default=10000)
+    parser.add_argument('--respawns', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+    # the workers and youtube-dl talk, keep stdout for the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+
+    root = tempfile.mkdtemp(prefix='ytdl-bench-')
+    os.environ.update({
+        # the forkserver does not get our sys.path to preload the fake extractors
+        'PYTHONPATH': os.pathsep.join(sys.path[:2] + [os.environ.get('PYTHONPATH', '')]),
+        'YTDL_ROOT': os.path.join(root, 'downloads'),
+        'YTDL_MIN_WORKERS': str(args.workers),
+        'YTDL_MAX_WORKERS': str(args.workers),
+    })
+    media = os.path.join(root, 'media')
+    os.makedirs(media)
+    media_server, os.environ['YTDL_BENCH_MEDIA'] = serve_media(media, args.media_size)
+    # installs the fake extractors in this process too, for forked workers
+    importlib.import_module('fake_extractors')
+    if processes.context.get_start_method() == 'forkserver':
+        processes.context.set_forkserver_preload(
+            ['youtube_dl_server.youtube', 'youtube_dl_server.ytdl', 'fake_extractors'])
+    from youtube_dl_server.server import app
+
+    try:
+        app.setup()
+        app.hub.start()
+        app.ensure_workers()
+        app.supervisor.start()
+        results = {
+            'python': platform.python_version(),
+            'started_at': time.time(),
+            'startup_seconds': bench_startup(args.respawns),
+            'end_to_end': bench_end_to_end(app, args.playlist_size, args.timeout),
+            'state': bench_state(app, args.state_sizes, args.state_requests),
+            'inform': bench_inform(app, args.ticks),
+        }
+        app.supervisor.stop()
+        results['respawn_seconds'] = bench_respawn(app, args.respawns, args.timeout)
+    finally:
+        for w in app.workers + app.info_getters + app.postprocessors:
+            w.terminate()
+        media_server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out, file=stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Fake extractors for the benchmarks, youtube-dl knows them once this is imported.
+
+The workers start from the forkserver, so it is preloaded there too. Videos
+are a video and an audio stream on the media server at $YTDL_BENCH_MEDIA.
+"""
+import os
+import re
+import sys
+
+from youtube_dl.extractor.common import InfoExtractor
+import youtube_dl.extractor
+
+
+class FakePlaylistIE(InfoExtractor):
+    """fake://playlist/<id>/<size> lists `size` fake videos"""
+    _VALID_URL = r'fake://playlist/(?P<id>\w+)/(?P<size>\d+)'
+
+    def _real_extract(self, url):
+        playlist_id, size = re.match(self._VALID_URL, url).groups()
+        entries = [
+            self.url_result('fake://video/{}-{}'.format(playlist_id, i), ie='FakeVideo')
+            for i in range(int(size))
+        ]
+        return self.playlist_result(entries, playlist_id, 'Playlist ' + playlist_id)
+
+
+class FakeVideoIE(InfoExtractor):
+    """fake://video/<id> is a video and an audio stream on the media server"""
+    _VALID_URL = r'fake://video/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        media = os.environ['YTDL_BENCH_MEDIA']
+        return {
+            'id': video_id,
+            'title': 'Video ' + video_id,
+            'formats': [
+                {'format_id': 'video', 'url': media + '/video.mp4', 'ext': 'mp4',
+                 'vcodec': 'avc1', 'acodec': 'none'},
+                {'format_id': 'audio', 'url': media + '/audio.m4a', 'ext': 'm4a',
+                 'vcodec': 'none', 'acodec': 'mp4a'},
+            ],
+        }
+
+
+def install():
+    """Make youtube-dl and our url_key know the fake extractors"""
+    original = youtube_dl.extractor.gen_extractor_classes
+
+    def gen_extractor_classes():
+        return [FakePlaylistIE, FakeVideoIE] + original()
+
+    from youtube_dl_server import ytdl
+    # looked up by name when they are given as ie_key
+    youtube_dl.extractor.FakePlaylistIE = FakePlaylistIE
+    youtube_dl.extractor.FakeVideoIE = FakeVideoIE
+    sys.modules['youtube_dl.YoutubeDL'].gen_extractor_classes = gen_extractor_classes
+    ytdl.gen_extractor_classes = gen_extractor_classes
+
+
+install()
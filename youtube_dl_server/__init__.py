@@ -1,3 +1,13 @@
-from youtube_dl_server.server import run
+import time
+
+# how long it takes until we serve is measured from here
+STARTED_AT = time.monotonic()
+
+
+def run():
+    # imported to run it only, workers import the package too
+    from youtube_dl_server.server import run
+    run()
+
 
 __ALL__ = ['run']
@@ -0,0 +1,50 @@
+import os
+
+
+def video_key(extractor_key, video_id):
+    """How youtube-dl identifies a video in its download archive"""
+    return '{} {}'.format(extractor_key.lower(), video_id)
+
+
+class Archive:
+    """youtube-dl's download archive as a set of `video_key`s.
+
+    youtube-dl only ever appends to the archive file, so on every lookup we
+    read what was appended since the last one instead of scanning the whole
+    file again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = set()
+        self._offset = 0
+
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if size < self._offset:
+            # truncated or replaced, start over
+            self._keys = set()
+            self._offset = 0
+        if size == self._offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        # a line that is still being written is read next time
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.decode('utf-8').splitlines():
+            line = line.strip()
+            if line:
+                self._keys.add(line)
+
+    def __contains__(self, key):
+        self.refresh()
+        return key in self._keys
+
+    def __len__(self):
+        self.refresh()
+        return len(self._keys)
@@ -0,0 +1,38 @@
+import time
+
+
+class Autoscaler:
+    """Decides how many downloaders we want between `minimum` and `maximum`.
+
+    One downloader per download that is queued or running, unless the
+    downloaders already get less than `target_speed` bytes/s each, then the
+    link is saturated and more of them would only share it. We grow right
+    away but only shrink once we wanted less for `cooldown` seconds.
+    """
+
+    def __init__(self, minimum, maximum, target_speed=0, cooldown=60):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_speed = target_speed
+        self.cooldown = cooldown
+        self._shrink_since = None
+
+    def wanted(self, busy, queued, throughput):
+        wanted = busy + queued
+        if self.target_speed and busy and throughput / busy < self.target_speed:
+            wanted = min(wanted, busy)
+        return max(self.minimum, min(self.maximum, wanted))
+
+    def __call__(self, current, busy, queued, throughput):
+        """The number of downloaders we should have now"""
+        wanted = self.wanted(busy, queued, throughput)
+        if wanted >= current:
+            self._shrink_since = None
+            return wanted
+        now = time.monotonic()
+        if self._shrink_since is None:
+            self._shrink_since = now
+        if now - self._shrink_since < self.cooldown:
+            return current
+        self._shrink_since = None
+        return wanted
@@ -0,0 +1,93 @@
+from threading import Thread
+import time
+
+from youtube_dl_server.processes import Event
+from youtube_dl_server.task import PLAYLIST_PRIORITY
+
+
+def shares(rate, priorities):
+    """Split `rate` between downloads of `priorities`.
+
+    Every `PLAYLIST_PRIORITY` a download is behind the first ones halves its
+    share, so playlist entries leave most of the link to single videos.
+    """
+    if not priorities:
+        return []
+    first = min(priorities)
+    weights = [0.5 ** ((p - first) / PLAYLIST_PRIORITY) for p in priorities]
+    total = sum(weights)
+    return [rate * weight / total for weight in weights]
+
+
+class Limiter:
+    """Keeps the bytes counted with `take` at a rate, measured over the last `window` seconds.
+
+    youtube-dl's own ratelimit compares it with the average speed since the
+    download started, lowering it halfway stalls the download for minutes
+    and raising it lets the download run unlimited until the average caught
+    up. Here every change of the rate starts over, also while we sleep.
+    """
+
+    def __init__(self, window=2, tick=0.25):
+        self.window = window
+        self.tick = tick
+        self._rate = None
+        self._start = None
+        self._bytes = 0
+
+    def take(self, n, rate):
+        """Count `n` more bytes and sleep while they are ahead of `rate()` bytes/s, None is unlimited"""
+        now = time.monotonic()
+        self._follow(rate(), now)
+        self._bytes += n
+        while self._rate:
+            ahead = self._bytes / self._rate - (now - self._start)
+            # not worth a sleep
+            if ahead < 0.001:
+                break
+            time.sleep(min(ahead, self.tick))
+            now = time.monotonic()
+            self._follow(rate(), now)
+        if now - self._start > self.window:
+            self._start, self._bytes = now, 0
+
+    def _follow(self, rate, now):
+        if self._start is not None and rate == self._rate:
+            return
+        # what we are still ahead of the old rate counts against the new one
+        owed = max(0, self._bytes - (now - self._start) * self._rate) if self._rate else 0
+        self._rate, self._start, self._bytes = rate, now, owed
+
+
+class Governor(Thread):
+    """Shares `rate` bytes/s between the downloaders.
+
+    Every downloader has a shared `rate` it keeps its download at, see
+    `YTWorker.throttle`, the busy ones get their share of the budget by the priority
+    of their task, idle ones what a new download would get. Workers set
+    `changed` when they start or finish a download, then the budget is
+    shared out again right away, otherwise every `interval` seconds.
+    """
+
+    def __init__(self, rate, workers, interval=1):
+        super(Governor, self).__init__(daemon=True, name='governor')
+        self.rate = rate
+        # returns the downloaders
+        self.workers = workers
+        self.interval = interval
+        self.changed = Event()
+
+    def run(self):
+        while True:
+            self.changed.wait(self.interval)
+            self.changed.clear()
+            self.rebalance()
+
+    def rebalance(self):
+        workers = [w for w in self.workers() if w.is_alive()]
+        busy = [w for w in workers if w.busy.value]
+        for w, share in zip(busy, shares(self.rate, [w.priority.value for w in busy])):
+            w.rate.value = share
+        for w in workers:
+            if not w.busy.value:
+                w.rate.value = self.rate / (len(busy) + 1)
@@ -0,0 +1,117 @@
+import json
+import time
+
+from youtube_dl_server.archive import video_key
+from youtube_dl_server.db import Database
+from youtube_dl_server.processes import Array
+from youtube_dl_server.utils import maybe_remove
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS info_created_at ON info (created_at);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_key ON urls (key);
+"""
+
+# indexes into the stats shared by all processes
+HITS, MISSES, EVICTIONS = 0, 1, 2
+
+
+class InfoCache(Database):
+    """Resolved video infos for `ttl` seconds, by extractor and id and by every url they were requested with.
+
+    Media urls in the infos expire after a while (a few hours for youtube),
+    so keep the ttl below that.
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, path, ttl):
+        super(InfoCache, self).__init__(path)
+        self.ttl = ttl
+        self.stats = Array('L', 3)
+
+    def _count(self, stat, n=1):
+        with self.stats.get_lock():
+            self.stats[stat] += n
+
+    def get(self, url=None, key=None):
+        row = None
+        if key is not None:
+            row = self.db.execute(
+                'SELECT key, info, created_at FROM info WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None and url is not None:
+            row = self.db.execute(
+                'SELECT info.key, info, created_at FROM urls JOIN info ON urls.key = info.key '
+                'WHERE url = ?', (url,)
+            ).fetchone()
+        if row is None:
+            self._count(MISSES)
+            return None
+        key, info, created_at = row
+        if created_at < time.time() - self.ttl:
+            self.invalidate(key=key)
+            self._count(MISSES)
+            return None
+        self._count(HITS)
+        return json.loads(info)
+
+    def put(self, info, *urls):
+        key = video_key(info['extractor_key'], info['id'])
+        info = dict(info)
+        # picked for the last download, selected again on the next
+        maybe_remove(info, 'requested_formats')
+        urls = set(urls)
+        urls.add(info['webpage_url'])
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO info (key, info, created_at) VALUES (?, ?, ?)',
+                (key, json.dumps(info), time.time()),
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO urls (url, key) VALUES (?, ?)',
+                ((url, key) for url in urls),
+            )
+
+    def invalidate(self, url=None, key=None):
+        """Forget the info of `url` or `key`, everything without either. Returns how many were forgotten."""
+        with self.transaction() as db:
+            if key is None and url is not None:
+                row = db.execute('SELECT key FROM urls WHERE url = ?', (url,)).fetchone()
+                if row is None:
+                    return 0
+                key, = row
+            if key is None:
+                n = db.execute('DELETE FROM info').rowcount
+                db.execute('DELETE FROM urls')
+            else:
+                n = db.execute('DELETE FROM info WHERE key = ?', (key,)).rowcount
+                db.execute('DELETE FROM urls WHERE key = ?', (key,))
+        self._count(EVICTIONS, n)
+        return n
+
+    def evict(self):
+        """Forget every expired info"""
+        with self.transaction() as db:
+            n = db.execute(
+                'DELETE FROM info WHERE created_at < ?', (time.time() - self.ttl,)
+            ).rowcount
+            if n:
+                db.execute('DELETE FROM urls WHERE key NOT IN (SELECT key FROM info)')
+        self._count(EVICTIONS, n)
+        return n
+
+    def as_dict(self):
+        return {
+            'hits': self.stats[HITS],
+            'misses': self.stats[MISSES],
+            'evictions': self.stats[EVICTIONS],
+        }
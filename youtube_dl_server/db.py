@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+
+
+class Database:
+    """SQLite database shared by the server and all workers.
+
+    Every process (and thread) gets its own connection, the database runs in
+    WAL mode so readers never block the one writer.
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # to start workers, they connect on their own
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        # connections must neither cross threads nor forks
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(self.SCHEMA)
+        return db
+
+    @contextmanager
+    def transaction(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
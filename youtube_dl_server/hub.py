@@ -0,0 +1,81 @@
+from queue import Empty
+from threading import Condition
+from threading import Thread
+import time
+import traceback
+
+from youtube_dl_server.state import FIELDS
+
+
+class Hub(Thread):
+    """Applies the workers state events and fans the changes out to every subscriber.
+
+    Workers put `(url, item)` for every entry they informed about into
+    `events`, or `(url, None)` to delete it, this thread is the only one writing them into `state` and
+    persists the changed entries in batches to the `store`.
+    Bursts are coalesced for `window` seconds and then all waiting subscribers
+    are woken up at once. Subscribers that wait on the same version share one
+    computed change set, per projection of the fields.
+    """
+
+    def __init__(self, state, events, store, window=0.1):
+        super(Hub, self).__init__(daemon=True, name='hub')
+        self.state = state
+        self.events = events
+        self.store = store
+        self._dirty = set()
+        self.window = window
+        self.version = state.version
+        self.changed = Condition()
+        self._changes = {}
+
+    def run(self):
+        while True:
+            try:
+                self.apply(*self.events.get())
+                deadline = time.monotonic() + self.window
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        self.apply(*self.events.get(timeout=remaining))
+                    except Empty:
+                        break
+                self.persist()
+            except Exception:
+                # we are the only ones applying the events, keep going, what was not
+                # saved is saved with the next batch
+                traceback.print_exc()
+            self.publish()
+
+    def apply(self, url, item):
+        if item is None:
+            self.state.delete(url)
+        else:
+            self.state.update(url, item)
+        self._dirty.add(url)
+
+    def persist(self):
+        items = self.state.records(self._dirty)
+        self.store.save_state(items)
+        deleted = self._dirty - set(items)
+        if deleted:
+            self.store.delete_state(deleted)
+        self._dirty = set()
+
+    def publish(self):
+        with self.changed:
+            self.version = self.state.version
+            self._changes = {}
+            self.changed.notify_all()
+
+    def wait(self, version, timeout=None, fields=FIELDS):
+        """Block until there is something newer than `version` and return the change set"""
+        with self.changed:
+            # a version from the future means we restarted, since() starts over
+            if version <= self.state.version:
+                self.changed.wait_for(lambda: self.version > version, timeout)
+            if (version, fields) not in self._changes:
+                self._changes[version, fields] = self.state.since(version, fields)
+            return self._changes[version, fields]
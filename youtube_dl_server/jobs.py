@@ -0,0 +1,413 @@
+import json
+import time
+
+from youtube_dl_server.db import Database
+from youtube_dl_server.task import ANALYSE
+from youtube_dl_server.task import DOWNLOAD
+from youtube_dl_server.task import Task
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    key TEXT,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    submission INTEGER,
+    task TEXT NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, stage, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_url ON jobs (url);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at);
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY,
+    served_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timeline (
+    job INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    at REAL NOT NULL,
+    worker TEXT
+);
+CREATE INDEX IF NOT EXISTS timeline_job ON timeline (job);
+CREATE TABLE IF NOT EXISTS state (
+    url TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS state_updated_at ON state (updated_at);
+CREATE TABLE IF NOT EXISTS known (
+    key TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    url TEXT PRIMARY KEY,
+    task TEXT,
+    interval REAL,
+    newest TEXT,
+    scheduled_at REAL,
+    synced_at REAL
+);
+"""
+
+# job status
+QUEUED = 'queued'
+CLAIMED = 'claimed'
+DONE = 'done'
+ERROR = 'error'
+
+
+class JobStore(Database):
+    """Durable job queue and state persistence, shared by the server and all workers.
+
+    Workers claim jobs atomically and mark them done or failed, claims of
+    workers that died or took longer than `claim_timeout` seconds are
+    released back into the queue.
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, path, poll=0.2, claim_timeout=6 * 60 * 60):
+        super(JobStore, self).__init__(path)
+        self.poll = poll
+        self.claim_timeout = claim_timeout
+
+    def put(self, task):
+        return self.put_many([task])[0]
+
+    def put_many(self, tasks, synced=None):
+        """Queue all tasks in one transaction and return their job ids.
+
+        A url or video that is already queued or being worked on in the same
+        stage is not queued twice, its task is merged into the existing job.
+        `synced` is the `(url, newest)` of the sync that found the tasks, its
+        mark only moves on together with them.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            if synced is not None:
+                self._synced(db, *synced)
+            for task in tasks:
+                row = self._in_flight(db, task)
+                task.merged = row is not None
+                if row is None:
+                    task.id = db.execute(
+                        'INSERT INTO jobs (url, key, stage, status, priority, submission, task, '
+                        'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (
+                            task.url, task.key, task.stage, QUEUED, task.priority, task.submission,
+                            json.dumps(task.as_dict()), now, now,
+                        ),
+                    ).lastrowid
+                    self._mark(db, task.id, QUEUED, now)
+                else:
+                    task.id = row[0]
+        return [task.id for task in tasks]
+
+    def _in_flight(self, db, task):
+        row = db.execute(
+            'SELECT id FROM jobs WHERE url = ? AND stage = ? AND status IN (?, ?) LIMIT 1',
+            (task.url, task.stage, QUEUED, CLAIMED),
+        ).fetchone()
+        if row is None and task.key is not None:
+            row = db.execute(
+                'SELECT id FROM jobs WHERE key = ? AND stage = ? AND status IN (?, ?) LIMIT 1',
+                (task.key, task.stage, QUEUED, CLAIMED),
+            ).fetchone()
+        return row
+
+    def in_flight(self, task):
+        return self._in_flight(self.db, task) is not None
+
+    def busy(self, keys, task):
+        """Those of the video `keys` that are queued or worked on in any stage for another
+        submission than that of the claimed `task`.
+
+        Of two analyses of the same video the earlier one goes on, each of
+        them would give way to the other otherwise.
+        """
+        submission = task.submission or task.id
+        keys = list(keys)
+        busy = set()
+        # at most 999 variables in a statement with older SQLite
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            busy.update(key for key, in self.db.execute(
+                'SELECT DISTINCT key FROM jobs WHERE key IN ({}) AND status IN (?, ?) '
+                'AND COALESCE(submission, id) IS NOT ? AND (stage != ? OR id < ?)'.format(', '.join('?' * len(chunk))),
+                (*chunk, QUEUED, CLAIMED, submission, ANALYSE, task.id),
+            ))
+        return busy
+
+    def claim(self, worker, stages):
+        """Claim the next job of the `stages` for `worker`.
+
+        Lowest priority first, within a priority round robin between the
+        submissions so one huge playlist does not block everybody else.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            rows = db.execute(
+                'UPDATE jobs SET status = ?, claimed_by = ?, claimed_at = ?, updated_at = ? '
+                'WHERE id = ('
+                '  SELECT jobs.id FROM jobs'
+                '  LEFT JOIN submissions ON submissions.id = COALESCE(jobs.submission, jobs.id)'
+                '  WHERE status = ? AND stage IN ({})'
+                '  ORDER BY priority, COALESCE(served_at, 0), jobs.id LIMIT 1'
+                ') RETURNING id, COALESCE(submission, id), task, created_at'.format(', '.join('?' * len(stages))),
+                (CLAIMED, worker, now, now, QUEUED, *stages),
+            ).fetchall()
+            if not rows:
+                return None
+            id_, submission, task, created_at = rows[0]
+            db.execute(
+                'INSERT OR REPLACE INTO submissions (id, served_at) VALUES (?, ?)', (submission, now)
+            )
+            self._mark(db, id_, CLAIMED, now, worker)
+        task = Task.from_dict(json.loads(task), id=id_)
+        task.created_at = created_at
+        return task
+
+    def get(self, worker, stages, stop=None):
+        """Block until a job of one of the `stages` could be claimed for `worker`.
+
+        Returns None once the `stop` event is set.
+        """
+        while stop is None or not stop.is_set():
+            task = self.claim(worker, stages)
+            if task is not None:
+                return task
+            if stop is None:
+                time.sleep(self.poll)
+            else:
+                stop.wait(self.poll)
+
+    def depth(self, stage):
+        """How many jobs of `stage` are queued"""
+        n, = self.db.execute(
+            'SELECT COUNT(*) FROM jobs WHERE status = ? AND stage = ?', (QUEUED, stage)
+        ).fetchone()
+        return n
+
+    def renew(self, task):
+        self.db.execute(
+            'UPDATE jobs SET claimed_at = ? WHERE id = ? AND status = ?',
+            (time.time(), task.id, CLAIMED),
+        )
+
+    def finish(self, task, status=DONE):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, claimed_by = NULL, updated_at = ? WHERE id = ?',
+                (status, now, task.id),
+            )
+            self._mark(db, task.id, status, now)
+
+    def release(self, worker=None):
+        """Put claimed jobs back into the queue.
+
+        Only those of `worker` if given, otherwise all that were claimed
+        longer than `claim_timeout` ago. Returns the urls of the released jobs.
+        """
+        now = time.time()
+        if worker is None:
+            where, args = 'claimed_at < ?', (now - self.claim_timeout,)
+        else:
+            where, args = 'claimed_by = ?', (worker,)
+        with self.transaction() as db:
+            rows = db.execute(
+                'UPDATE jobs SET status = ?, claimed_by = NULL, updated_at = ? '
+                'WHERE status = ? AND {} RETURNING id, url'.format(where),
+                (QUEUED, now, CLAIMED, *args),
+            ).fetchall()
+            for id_, _ in rows:
+                self._mark(db, id_, QUEUED, now)
+        return [url for _, url in rows]
+
+    def recover(self):
+        """Queue every job again that was claimed when we went down"""
+        now = time.time()
+        with self.transaction() as db:
+            rows = db.execute(
+                'UPDATE jobs SET status = ?, claimed_by = NULL WHERE status = ? RETURNING id, url',
+                (QUEUED, CLAIMED),
+            ).fetchall()
+            for id_, _ in rows:
+                self._mark(db, id_, QUEUED, now)
+        return [url for _, url in rows]
+
+    def resumable(self, ids):
+        """Tasks to download the videos with the `ids` again whose last download failed.
+
+        Those still queued or claimed continue anyway and those that are
+        done are done.
+        """
+        last = {}
+        for id_, key, status in self.db.execute(
+            'SELECT id, key, status FROM jobs WHERE stage = ? AND key IS NOT NULL ORDER BY id', (DOWNLOAD,)
+        ):
+            # see `video_key`
+            video_id = key.partition(' ')[2]
+            if video_id in ids:
+                last[video_id] = (id_, status)
+        tasks = []
+        for id_, status in last.values():
+            if status == ERROR:
+                task, = self.db.execute('SELECT task FROM jobs WHERE id = ?', (id_,)).fetchone()
+                tasks.append(Task.from_dict(json.loads(task)))
+        return tasks
+
+    def resolved(self, task):
+        """Keep the video_key an analyser found for the submitted `task` with its job"""
+        self.db.execute(
+            'UPDATE jobs SET key = ?, task = ? WHERE id = ?', (task.key, json.dumps(task.as_dict()), task.id)
+        )
+
+    def key_of(self, url):
+        """The video_key of `url` if a job found it before"""
+        row = self.db.execute(
+            'SELECT key FROM jobs WHERE url = ? AND key IS NOT NULL ORDER BY id DESC LIMIT 1', (url,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def known(self, key):
+        """Whether there was a job for the video with `key` already"""
+        return (
+            self.db.execute('SELECT 1 FROM jobs WHERE key = ? LIMIT 1', (key,)).fetchone() is not None or
+            self.db.execute('SELECT 1 FROM known WHERE key = ?', (key,)).fetchone() is not None
+        )
+
+    def prune(self, ttl):
+        """Forget the jobs that finished more than `ttl` seconds ago with their timeline,
+        `known` keeps their videos. Returns how many were forgotten.
+        """
+        old = 'status IN (?, ?) AND updated_at < ?'
+        args = (DONE, ERROR, time.time() - ttl)
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR IGNORE INTO known (key) SELECT DISTINCT key FROM jobs WHERE key IS NOT NULL AND ' + old,
+                args,
+            )
+            db.execute('DELETE FROM timeline WHERE job IN (SELECT id FROM jobs WHERE ' + old + ')', args)
+            n = db.execute('DELETE FROM jobs WHERE ' + old, args).rowcount
+            db.execute('DELETE FROM submissions WHERE served_at < ?', args[-1:])
+        return n
+
+    def watch(self, task, interval=None):
+        """Sync the playlist of the sync `task` every `interval` seconds, only when asked if None"""
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO playlists (url, task, interval, scheduled_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (url) DO UPDATE SET task = excluded.task, interval = excluded.interval, '
+                'scheduled_at = excluded.scheduled_at',
+                (task.url, json.dumps(task.as_dict()), interval, time.time()),
+            )
+
+    def unwatch(self, url):
+        with self.transaction() as db:
+            return db.execute('DELETE FROM playlists WHERE url = ?', (url,)).rowcount > 0
+
+    def playlists(self):
+        columns = ('url', 'interval', 'newest', 'scheduled_at', 'synced_at')
+        for row in self.db.execute('SELECT {} FROM playlists ORDER BY url'.format(', '.join(columns))):
+            yield dict(zip(columns, row))
+
+    def due(self):
+        """Mark the playlists to sync now as scheduled and return their sync tasks.
+
+        Those that are still being synced wait for the next time.
+        """
+        now = time.time()
+        due = (
+            'interval IS NOT NULL AND COALESCE(scheduled_at, 0) + interval <= ? '
+            'AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.url = playlists.url AND status IN (?, ?))'
+        )
+        # asked every few moments, only write when there is something to do
+        if self.db.execute('SELECT 1 FROM playlists WHERE ' + due + ' LIMIT 1', (now, QUEUED, CLAIMED)).fetchone() is None:
+            return []
+        with self.transaction() as db:
+            rows = db.execute(
+                'UPDATE playlists SET scheduled_at = ? WHERE ' + due + ' RETURNING task', (now, now, QUEUED, CLAIMED),
+            ).fetchall()
+        return [Task.from_dict(json.loads(task)) for task, in rows]
+
+    def high_water_mark(self, url):
+        """The id of the newest entry of the playlist the last sync saw"""
+        row = self.db.execute('SELECT newest FROM playlists WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def _synced(self, db, url, newest):
+        db.execute(
+            'INSERT INTO playlists (url, newest, synced_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (url) DO UPDATE SET newest = COALESCE(excluded.newest, newest), '
+            'synced_at = excluded.synced_at',
+            (url, newest, time.time()),
+        )
+
+    def _mark(self, db, job, status, at, worker=None):
+        db.execute(
+            'INSERT INTO timeline (job, status, at, worker) VALUES (?, ?, ?, ?)', (job, status, at, worker)
+        )
+
+    def mark(self, task, status, worker=None):
+        """Note in the timeline of `task` that it went to `status` now"""
+        self._mark(self.db, task.id, status, time.time(), worker)
+
+    def timeline(self, id_):
+        """The job `id_` and the jobs following from it for the same url, each with its timeline.
+
+        None if there is no such job.
+        """
+        row = self.db.execute('SELECT url, COALESCE(submission, id) FROM jobs WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return None
+        url, submission = row
+        jobs = []
+        for job, stage, status in self.db.execute(
+            'SELECT id, stage, status FROM jobs WHERE url = ? AND (id = ? OR submission = ?) AND id >= ? '
+            'ORDER BY id',
+            (url, submission, submission, id_),
+        ).fetchall():
+            events = self.db.execute(
+                'SELECT status, at, worker FROM timeline WHERE job = ? ORDER BY at, rowid', (job,)
+            ).fetchall()
+            jobs.append({
+                'id': job,
+                'stage': stage,
+                'status': status,
+                'timeline': [
+                    {'status': status, 'at': at, 'worker': worker} for status, at, worker in events
+                ],
+            })
+        return {'url': url, 'jobs': jobs}
+
+    def info(self, url):
+        """The full info of the last job for `url`"""
+        row = self.db.execute(
+            'SELECT task FROM jobs WHERE url = ? ORDER BY id DESC LIMIT 1', (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])['info']
+
+    def save_state(self, items):
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO state (url, item, updated_at) VALUES (?, ?, ?)',
+                ((url, json.dumps(item), now) for url, item in items.items()),
+            )
+
+    def delete_state(self, urls):
+        with self.transaction() as db:
+            db.executemany('DELETE FROM state WHERE url = ?', ((url,) for url in urls))
+
+    def load_state(self):
+        for url, item in self.db.execute('SELECT url, item FROM state ORDER BY updated_at'):
+            yield url, json.loads(item)
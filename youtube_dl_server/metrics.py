@@ -0,0 +1,116 @@
+from youtube_dl_server.jobs import DONE
+from youtube_dl_server.jobs import ERROR
+from youtube_dl_server.processes import Array
+from youtube_dl_server.task import ANALYSE
+from youtube_dl_server.task import DOWNLOAD
+from youtube_dl_server.task import POSTPROCESS
+
+STAGES = (ANALYSE, DOWNLOAD, POSTPROCESS)
+# seconds, starting a worker takes milliseconds, analysing a few seconds, post
+# processing minutes and downloads up to hours
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600,
+    float('inf'),
+)
+
+HISTOGRAMS = {
+    'ytdl_queue_wait_seconds': ('Seconds a job waited in the queue until a worker claimed it', ('stage',)),
+    'ytdl_task_seconds': ('Seconds a worker spent on a job', ('stage',)),
+    'ytdl_worker_start_seconds': ('Seconds from starting a worker until it ran', ()),
+}
+COUNTERS = {
+    'ytdl_tasks_total': ('Jobs that were finished by stage and status', ('stage', 'status')),
+    'ytdl_downloaded_bytes_total': ('Bytes downloaded', ()),
+    'ytdl_worker_restarts_total': ('Workers that died and were replaced', ()),
+}
+LABEL_VALUES = {
+    'stage': STAGES,
+    'status': (DONE, ERROR),
+}
+
+
+def _label_sets(names):
+    sets = [()]
+    for name in names:
+        sets = [labels + ((name, value),) for labels in sets for value in LABEL_VALUES[name]]
+    return sets
+
+
+def _format_labels(labels, **more):
+    pairs = list(labels) + list(more.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metrics:
+    """Counters and histograms shared by all processes, see `render` for /metrics.
+
+    Every series has a fixed place in one shared array, so recording a value
+    is an addition under its lock. Histograms take a counter per bucket plus
+    their sum and count.
+    """
+
+    def __init__(self):
+        self._offsets = {}
+        size = 0
+        for name, (_, label_names) in HISTOGRAMS.items():
+            for labels in _label_sets(label_names):
+                self._offsets[name, labels] = size
+                size += len(BUCKETS) + 2
+        for name, (_, label_names) in COUNTERS.items():
+            for labels in _label_sets(label_names):
+                self._offsets[name, labels] = size
+                size += 1
+        self._values = Array('d', size)
+
+    def observe(self, name, value, **labels):
+        offset = self._offsets[name, tuple(labels.items())]
+        bucket = next(i for i, bound in enumerate(BUCKETS) if value <= bound)
+        with self._values.get_lock():
+            self._values[offset + bucket] += 1
+            self._values[offset + len(BUCKETS)] += value
+            self._values[offset + len(BUCKETS) + 1] += 1
+
+    def count(self, name, n=1, **labels):
+        offset = self._offsets[name, tuple(labels.items())]
+        with self._values.get_lock():
+            self._values[offset] += n
+
+    def render(self, extra=None):
+        """The Prometheus text exposition of everything and the `extra` metrics
+        kept elsewhere, a dict of name -> (help, type, [(labels, value)])
+        """
+        values = self._values[:]
+        lines = []
+        for name, (help_, label_names) in HISTOGRAMS.items():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels in _label_sets(label_names):
+                offset = self._offsets[name, labels]
+                cumulative = 0
+                for i, bound in enumerate(BUCKETS):
+                    cumulative += values[offset + i]
+                    le = '+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels, le=le), _format_value(cumulative)))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), _format_value(values[offset + len(BUCKETS)])))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), _format_value(values[offset + len(BUCKETS) + 1])))
+        for name, (help_, label_names) in COUNTERS.items():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels in _label_sets(label_names):
+                value = values[self._offsets[name, labels]]
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        for name, (help_, type_, series) in (extra or {}).items():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for labels, value in series:
+                lines.append('{}{} {}'.format(name, _format_labels(tuple(labels.items())), _format_value(value)))
+        return '\n'.join(lines) + '\n'
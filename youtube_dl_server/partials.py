@@ -0,0 +1,21 @@
+import os
+import re
+
+# youtube-dl downloads to `<name>.part`, fragmented formats go to
+# `<name>.part-Frag<n>` and keep how far they got in `<name>.ytdl`
+PARTIAL = re.compile(r'\.(part|part-Frag\d+|ytdl)$')
+# the output template puts the id of the video last in brackets
+VIDEO_ID = re.compile(r'\[([\w-]+)\][^\[\]]*$')
+
+
+def scan(root):
+    """The partial files under `root` by the id of the video they belong to"""
+    partials = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if not PARTIAL.search(name):
+                continue
+            match = VIDEO_ID.search(name)
+            if match is not None:
+                partials.setdefault(match.group(1), []).append(os.path.join(directory, name))
+    return partials
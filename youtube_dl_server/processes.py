@@ -0,0 +1,19 @@
+"""Where the workers and everything they share with the server come from.
+
+Workers are forked from a fork server that imported youtube-dl already, so
+starting one takes milliseconds and the server itself does not need to
+import youtube-dl. Locks, queues and shared values have to be created in
+the same context as the processes using them.
+"""
+import multiprocessing
+import os
+
+context = multiprocessing.get_context(os.environ.get('YTDL_START_METHOD', 'forkserver'))
+if context.get_start_method() == 'forkserver':
+    context.set_forkserver_preload(['youtube_dl_server.youtube', 'youtube_dl_server.ytdl'])
+
+Array = context.Array
+Event = context.Event
+Process = context.Process
+Queue = context.Queue
+Value = context.Value
@@ -1,36 +1,159 @@
+import gzip
+import json
 import os
-from multiprocessing import JoinableQueue
-from multiprocessing import Manager
+from socketserver import ThreadingMixIn
+from threading import BoundedSemaphore
 from wsgiref.simple_server import WSGIServer
 import signal
+import time
+import uuid
+import zlib
 
 from bottle import Bottle
+from bottle import HTTPResponse
 from bottle import request
+from bottle import response
 from bottle import static_file
 
-from youtube_dl_server.youtube import Task
+from youtube_dl_server import STARTED_AT
+from youtube_dl_server.archive import Archive
+from youtube_dl_server.autoscale import Autoscaler
+from youtube_dl_server.bandwidth import Governor
+from youtube_dl_server.cache import HITS
+from youtube_dl_server.cache import InfoCache
+from youtube_dl_server.cache import MISSES
+from youtube_dl_server.hub import Hub
+from youtube_dl_server.jobs import JobStore
+from youtube_dl_server.metrics import Metrics
+from youtube_dl_server.metrics import STAGES
+from youtube_dl_server.partials import scan
+from youtube_dl_server.processes import Array
+from youtube_dl_server.processes import Queue
+from youtube_dl_server.processes import Value
+from youtube_dl_server.state import DEFAULT_FIELDS
+from youtube_dl_server.state import FIELDS
+from youtube_dl_server.state import State
+from youtube_dl_server.supervisor import Supervisor
+from youtube_dl_server.task import DOWNLOAD
+from youtube_dl_server.task import POSTPROCESS
+from youtube_dl_server.task import PRIORITY
+from youtube_dl_server.task import Task
 from youtube_dl_server.youtube import YTWorker
 from youtube_dl_server.youtube import DEFAULT_TEMPLATE
+from youtube_dl_server.youtube import MERGED
+from youtube_dl_server.youtube import SENT
 
 ROOT = os.path.join(os.path.dirname(__file__), 'static')
+# upper bound for long polls on /state?since=..&wait=..
+MAX_WAIT = 60
+# seconds between events on /state/stream when nothing changes
+HEARTBEAT = 15
+# answer to connections beyond YTDL_MAX_CONNECTIONS
+BUSY = (
+    b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Retry-After: 1\r\n'
+    b'Content-Length: 0\r\n'
+    b'Connection: close\r\n\r\n'
+)
 
 
-class Server(WSGIServer):
-    def service_actions(self):
-        self.application.ensure_workers()
+class Server(ThreadingMixIn, WSGIServer):
+    """Handles every connection in its own thread, at most `max_connections` at once.
 
+    Further connections are answered with a 503 right away, waiting for a
+    slot would hold up accepting every other connection.
+    """
+
+    # /state/stream and long polls keep their connection open
+    daemon_threads = True
+    max_connections = int(os.environ.get('YTDL_MAX_CONNECTIONS', 64))
+    request_queue_size = 128
 
-class App(Bottle):
     def __init__(self, *args, **kwargs):
-        super(App, self).__init__(*args, **kwargs)
-        self._manager = Manager()
-        self.state = self._manager.dict()
-        self.workers = []
-        self.queue = JoinableQueue()
+        self._connections = BoundedSemaphore(self.max_connections)
+        super(Server, self).__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        if not self._connections.acquire(blocking=False):
+            try:
+                request.sendall(BUSY)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super(Server, self).process_request(request, client_address)
+        except:
+            self._connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(Server, self).process_request_thread(request, client_address)
+        finally:
+            self._connections.release()
+
+
+class App(Bottle):
+    """The routes are added when the module is imported, everything else is set up
+    once the app runs, see `setup`.
+    """
+
+    def setup(self):
+        """Open the databases and create what the workers share.
+
+        Not done on import: the fork server imports the module as the main
+        module when the server runs as `python -m youtube_dl_server.server`.
+        """
         self._root = os.environ.get('YTDL_ROOT', 'downloads')
+        self.state = State()
+        # versions start over with every run, ETags must not match across them
+        self.instance = uuid.uuid4().hex[:8]
+        self.events = Queue()
+        self.workers = []
+        self.queue = JobStore(
+            os.environ.get('YTDL_DB', os.path.join(self._root, '.youtube-dl-server.sqlite')),
+            claim_timeout=float(os.environ.get('YTDL_CLAIM_TIMEOUT', 6 * 60 * 60)),
+        )
+        self.hub = Hub(self.state, self.events, self.queue)
+        self.cache = InfoCache(
+            os.environ.get('YTDL_CACHE', os.path.join(self._root, '.youtube-dl-cache.sqlite')),
+            ttl=float(os.environ.get('YTDL_CACHE_TTL', 60 * 60)),
+        )
+        self._cache_evicted_at = 0
+        # finished jobs are forgotten after a month
+        self.job_ttl = float(os.environ.get('YTDL_JOB_TTL', 30 * 24 * 60 * 60))
+        self.archive = Archive(os.environ.get('YTDL_ARCHIVE', os.path.join(self._root, 'history.txt')))
         self._template = os.environ.get('YTDL_TEMPLATE', DEFAULT_TEMPLATE)
-        self.n_workers = 1
-        self.info_getter = None
+        # downloaders follow the queue between these, see `autoscale`
+        self.autoscaler = Autoscaler(
+            minimum=int(os.environ.get('YTDL_MIN_WORKERS', 1)),
+            maximum=int(os.environ.get('YTDL_MAX_WORKERS', 5)),
+            target_speed=float(os.environ.get('YTDL_WORKER_SPEED', 0)),
+        )
+        self.n_workers = self.autoscaler.minimum
+        # seconds between two progress updates of the same url
+        self.inform_interval = float(os.environ.get('YTDL_INFORM_INTERVAL', 0.25))
+        self.inform_counters = Array('L', 2)
+        # finished entries are forgotten after a week or when there are too many
+        self.state_ttl = float(os.environ.get('YTDL_STATE_TTL', 7 * 24 * 60 * 60))
+        self.state_max = int(os.environ.get('YTDL_STATE_MAX', 10000))
+        # playlist entries are resolved by this many info getters in parallel
+        self.n_analysers = int(os.environ.get('YTDL_ANALYSERS', 2))
+        self.info_getters = []
+        # merging is CPU bound, one post processor per core
+        self.n_postprocessors = int(os.environ.get('YTDL_POSTPROCESSORS', os.cpu_count() or 1))
+        self.postprocessors = []
+        self.postprocess_stats = Array('d', 2)
+        self.metrics = Metrics()
+        self.startup_seconds = None
+        # where the workers write a cProfile dump of every task, off if not set
+        self.profile_dir = os.environ.get('YTDL_PROFILE')
+        # a playlist sync stops after this many known entries in a row
+        self.sync_stop = int(os.environ.get('YTDL_SYNC_STOP', 10))
+        self.supervisor = Supervisor(self)
+        # bytes/s all downloads share, 0 is unlimited
+        self.governor = Governor(float(os.environ.get('YTDL_RATE_LIMIT', 0)), lambda: self.workers)
 
     @property
     def template(self):
@@ -39,41 +162,119 @@ class App(Bottle):
     def spawn_worker(self,  **kwargs):
         w = YTWorker(
             queue=self.queue,
-            state=self.state,
+            events=self.events,
+            busy=Value('b', False),
+            counters=self.inform_counters,
+            cache=self.cache,
+            archive=self.archive,
+            inform_interval=self.inform_interval,
             template=self.template,
-            proxy=self._manager.Namespace(),
+            rebalance=self.governor.changed if self.governor.rate else None,
+            metrics=self.metrics,
+            profile_dir=self.profile_dir,
+            sync_stop=self.sync_stop,
             **kwargs
         )
         w.start()
         return w
 
     def ensure_workers(self):
-        for i in range(len(self.workers)):
-            try:
-                w = self.workers[i]
-            except IndexError:
-                continue
-            if w.is_alive():
-                continue
+        self.reap(self.workers)
+        self.reap(self.info_getters)
+        self.reap(self.postprocessors)
+        self.autoscale()
+        for _ in range(self.n_workers - len(self.get_running_workers())):
+            self.workers.append(self.spawn_worker())
+        for _ in range(self.n_analysers - len(self.info_getters)):
+            self.info_getters.append(self.spawn_worker(download=False))
+        for _ in range(self.n_postprocessors - len(self.postprocessors)):
+            self.postprocessors.append(
+                self.spawn_worker(postprocess=True, postprocess_stats=self.postprocess_stats)
+            )
+        self.requeue(self.queue.release())
+        self.schedule_syncs()
+        self.evict()
+
+    def autoscale(self):
+        """Pick the number of downloaders and stop those we have too many"""
+        running = self.get_running_workers()
+        busy = [w for w in running if w.busy.value]
+        self.n_workers = self.autoscaler(
+            len(running), len(busy), self.queue.depth(DOWNLOAD), self.state.throughput,
+        )
+        # idle ones first, busy ones stop after their download
+        excess = sorted(running, key=lambda w: w.busy.value)[:max(0, len(running) - self.n_workers)]
+        for w in excess:
+            print(f"stopping {w}")
+            w.stopping.set()
+
+    def schedule_syncs(self):
+        """Queue the syncs of the playlists that are due"""
+        tasks = self.queue.due()
+        if tasks:
+            self.queue.put_many(tasks)
+            self.requeue([t.url for t in tasks if not t.merged])
+
+    def evict(self):
+        evicted = self.state.evict(self.state_ttl, self.state_max)
+        if evicted:
+            self.queue.delete_state(evicted)
+            self.hub.publish()
+        if time.monotonic() - self._cache_evicted_at > 60:
+            self.cache.evict()
+            self.queue.prune(self.job_ttl)
+            self._cache_evicted_at = time.monotonic()
+
+    def reap(self, workers):
+        """Remove the dead from `workers` and queue their jobs again"""
+        for w in [w for w in workers if not w.is_alive()]:
+            if w.stopping.is_set():
+                print(f"removing stopped worker {w}")
             else:
                 print(f"removing dead worker {w}")
-                del self.workers[i]
-        for _ in range(self.n_workers - len(self.get_alive_workers())):
-            self.workers.append(self.spawn_worker())
-        if self.info_getter is None or not self.info_getter.is_alive():
-            self.info_getter = self.spawn_worker(download=False)
+                self.metrics.count('ytdl_worker_restarts_total')
+            workers.remove(w)
+            self.requeue(self.queue.release(w.name))
+
+    def requeue(self, urls):
+        for url in urls:
+            print(f"requeued {url}")
+            self.events.put((url, {'status': 'pending'}))
 
+    def recover(self):
+        """Restore the state and queue the jobs again we were working on when we went down"""
+        for url, item in self.queue.load_state():
+            self.state.update(url, item)
+        self.requeue(self.queue.recover())
+        self.resume()
 
-    def run(self, n_workers=5, **kwargs):
-        self.n_workers = n_workers
+    def resume(self):
+        """Queue the failed downloads again that left partial files behind, they continue from there"""
+        partials = scan(self._root)
+        if not partials:
+            return
+        tasks = self.queue.resumable(partials)
+        self.queue.put_many(tasks)
+        print(f"found partial files of {len(partials)} videos, resuming {len(tasks)} failed downloads")
+        self.requeue([t.url for t in tasks if not t.merged])
+
+    def run(self, **kwargs):
+        self.setup()
+        self.recover()
         self.ensure_workers()
+        self.hub.start()
+        self.supervisor.start()
+        if self.governor.rate:
+            self.governor.start()
+        self.startup_seconds = time.monotonic() - STARTED_AT
+        print(f"Started in {self.startup_seconds:.2f}s")
         super(App, self).run(**kwargs)
 
     def get_busy_workers(self):
-        return [w for w in self.workers if w.proxy.busy and w.should_download and w.is_alive()]
+        return [w for w in self.workers if w.busy.value and w.should_download and w.is_alive()]
 
     def get_idle_workers(self):
-        return [w for w in self.workers if not w.proxy.busy and w.should_download]
+        return [w for w in self.workers if not w.busy.value and w.should_download]
 
     def get_dead_workers(self):
         return [w for w in self.workers if not w.is_alive()]
@@ -81,9 +282,14 @@ class App(Bottle):
     def get_alive_workers(self):
         return [w for w in self.workers if w.is_alive()]
 
+    def get_running_workers(self):
+        """Downloaders that are not stopping"""
+        return [w for w in self.workers if not w.stopping.is_set()]
+
 
 
     def close(self):
+        self.supervisor.stop()
         for w in self.workers:
             w.join()
         super(App, self).close()
@@ -104,13 +310,113 @@ def server_static(filename):
 
 @app.route('/state/done', method='DELETE')
 def delete_state():
-    state = dict(app.state)
-    for key, status in state.items():
-        if status.get('status') != 'done':
-            pass
-        else:
-            print("Removing {}".format(key))
-            del app.state[key]
+    _, state, _, _ = app.state.page(['done'], fields=())
+    deleted = []
+    for key in state:
+        print("Removing {}".format(key))
+        app.state.delete(key)
+        deleted.append(key)
+    app.queue.delete_state(deleted)
+    app.hub.publish()
+
+
+@app.route('/tasks/<id_:int>/timeline', method='GET')
+def task_timeline(id_):
+    """When the job and the ones following from it for the same url changed their status"""
+    timeline = app.queue.timeline(id_)
+    if timeline is None:
+        return {"success": False, "error": "unknown task"}
+    if app.profile_dir:
+        for job in timeline['jobs']:
+            path = os.path.join(app.profile_dir, '{}-{}.prof'.format(job['id'], job['stage']))
+            if os.path.exists(path):
+                job['profile'] = path
+    return dict(timeline, success=True)
+
+
+@app.route('/metrics', method='GET')
+def metrics():
+    """Prometheus text exposition"""
+    pools = (('downloader', app.workers), ('info_getter', app.info_getters), ('post_processor', app.postprocessors))
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return app.metrics.render({
+        'ytdl_queued_jobs': ('Jobs waiting in the queue', 'gauge', [
+            ({'stage': stage}, app.queue.depth(stage)) for stage in STAGES
+        ]),
+        'ytdl_workers': ('Workers by kind and whether they are busy', 'gauge', [
+            ({'kind': kind, 'state': state}, len([w for w in workers if w.is_alive() and w.busy.value == busy]))
+            for kind, workers in pools
+            for state, busy in (('busy', True), ('idle', False))
+        ]),
+        'ytdl_throughput_bytes': ('Bytes/s of all running downloads', 'gauge', [({}, app.state.throughput)]),
+        'ytdl_startup_seconds': ('Seconds from starting the server until it served', 'gauge', [
+            ({}, app.startup_seconds or 0),
+        ]),
+        'ytdl_informs_total': ('Progress updates of the workers, sent or merged into the next', 'counter', [
+            ({'result': 'sent'}, app.inform_counters[SENT]),
+            ({'result': 'merged'}, app.inform_counters[MERGED]),
+        ]),
+        'ytdl_cache_lookups_total': ('Lookups in the info cache', 'counter', [
+            ({'result': 'hit'}, app.cache.stats[HITS]),
+            ({'result': 'miss'}, app.cache.stats[MISSES]),
+        ]),
+    })
+
+
+@app.route('/sync', method='POST')
+def sync_put():
+    """Sync the playlist ?url= now, and every ?interval= seconds if given"""
+    url = request.forms.get('url')
+    try:
+        task = task_for(
+            url,
+            filter=request.forms.get('filter'),
+            indexes=request.forms.get('indexes'),
+            priority=request.forms.get('priority'),
+        )
+    except ValueError as e:
+        return {"success": False, "url": url, "error": str(e)}
+    try:
+        interval = float(request.forms.get('interval') or 0) or None
+    except ValueError:
+        return {"success": False, "url": url, "error": "interval has to be a number of seconds"}
+    task.sync = True
+    app.queue.watch(task, interval)
+    id_ = app.queue.put(task)
+    print("Added sync of " + url + " to the queue")
+    return {"success": True, "url": url, "interval": interval, "id": id_, "merged": task.merged}
+
+
+@app.route('/sync', method='GET')
+def sync_list():
+    return {"success": True, "playlists": list(app.queue.playlists())}
+
+
+@app.route('/sync', method='DELETE')
+def sync_delete():
+    """Stop syncing the playlist ?url="""
+    return {"success": app.queue.unwatch(request.query.get('url'))}
+
+
+@app.route('/cache', method='GET')
+def cache_stats():
+    return {"success": True, "cache": app.cache.as_dict()}
+
+
+@app.route('/cache', method='DELETE')
+def cache_invalidate():
+    """Forget the cached info of ?url= or everything"""
+    n = app.cache.invalidate(url=request.query.get('url'))
+    return {"success": True, "invalidated": n}
+
+
+@app.route('/state/info', method='GET')
+def state_info():
+    """The full info youtube-dl gave us for ?url="""
+    info = app.queue.info(request.query.get('url'))
+    if info is None:
+        return {"success": False, "error": "unknown url"}
+    return {"success": True, "info": info}
 
 
 @app.route('/state', method='GET')
@@ -453,29 +759,269 @@ def state():
     if test is not None:
         if datetime.datetime.now().second % 10 == 0:
             print("Injecting demo data")
-            app.state = demo
-    return {
+            for url, item in demo.items():
+                app.state.update(url, item)
+            app.hub.publish()
+
+    try:
+        fields = requested_fields()
+        page = requested_page()
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    since = request.query.get('since')
+    wait = request.query.get('wait')
+    changes = None
+    if since is not None and page is not None:
+        return {"success": False, "error": "since does not go together with status, limit and cursor"}
+    if since is not None:
+        try:
+            since = int(since)
+            wait = float(wait) if wait is not None else None
+        except ValueError:
+            return {"success": False, "error": "since and wait have to be numbers"}
+        if wait:
+            return send_json(state_payload(app.hub.wait(since, timeout=min(wait, MAX_WAIT), fields=fields), fields))
+    compress = accepts_gzip()
+    counters = state_counters()
+    etag = state_etag(app.state.version, compress, counters)
+    if etag in if_none_match():
+        # the client has this version already, nothing to serialize
+        return HTTPResponse(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'})
+    if page is not None:
+        version, entries, cursor, total = app.state.page(*page, fields=fields)
+        payload = state_payload((version, entries, []), fields, counters)
+        payload.update(cursor=cursor, total=total)
+    else:
+        if since is not None:
+            changes = app.state.since(since, fields)
+        payload = state_payload(changes, fields, counters)
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('ETag', state_etag(payload['version'], compress, counters))
+    return send_json(payload, compress)
+
+
+def requested_fields():
+    """The fields of the entries asked for with ?fields=, `all` for every one"""
+    fields = request.query.get('fields')
+    if not fields:
+        return DEFAULT_FIELDS
+    if fields == 'all':
+        return FIELDS
+    names = set(fields.split(','))
+    unknown = names - set(FIELDS)
+    if unknown:
+        raise ValueError("unknown fields: " + ', '.join(sorted(unknown)))
+    return tuple(field for field in FIELDS if field in names)
+
+
+def requested_page():
+    """The statuses, cursor and limit of the page asked for with ?status=, ?cursor= and ?limit=,
+    None without any of them
+    """
+    query = request.query
+    if not any(name in query for name in ('status', 'cursor', 'limit')):
+        return None
+    statuses = query.get('status').split(',') if query.get('status') else None
+    try:
+        cursor = int(query.get('cursor') or 0)
+        limit = int(query.get('limit')) if query.get('limit') else None
+    except ValueError:
+        raise ValueError("cursor and limit have to be numbers")
+    if limit is not None and limit < 0:
+        raise ValueError("limit can not be negative")
+    return statuses, cursor, limit
+
+
+def accepts_gzip():
+    for coding in request.headers.get('Accept-Encoding', '').replace(' ', '').split(','):
+        name, _, q = coding.partition(';q=')
+        if name in ('gzip', '*'):
+            try:
+                return float(q or 1) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def if_none_match():
+    """The ETags the client has, they only have to match weakly"""
+    tags = request.headers.get('If-None-Match', '').split(',')
+    return [tag.strip().replace('W/', '', 1) for tag in tags]
+
+
+def state_etag(version, compressed, counters):
+    """The same version and query give the same entries, the `counters` change without a new version"""
+    query = '&'.join('{}={}'.format(*item) for item in sorted(request.query.allitems()))
+    return '"{}-{}-{:x}-{:x}{}"'.format(
+        app.instance, version, zlib.crc32(query.encode()),
+        zlib.crc32(json.dumps(counters, sort_keys=True).encode()), '-gzip' if compressed else '',
+    )
+
+
+def send_json(payload, compress=None):
+    """`payload` as JSON, gzipped if the client takes it"""
+    body = json.dumps(payload).encode()
+    response.content_type = 'application/json'
+    response.add_header('Vary', 'Accept-Encoding')
+    if compress is None:
+        compress = accepts_gzip()
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+        response.set_header('Content-Encoding', 'gzip')
+    return body
+
+
+def state_payload(changes, fields=FIELDS, counters=None):
+    full = changes is None
+    if full:
+        changes = app.state.snapshot(fields)
+    version, entries, deleted = changes
+    payload = {
         'success' : True,
-        'state': dict(app.state),
+        'version': version,
+        'full': full,
+        'state': entries,
+        'deleted': deleted,
+    }
+    payload.update(counters or state_counters())
+    return payload
+
+
+def state_counters():
+    """What /state tells about the workers and the queue next to the entries"""
+    return {
         'workers': {
             'idle': len(app.get_idle_workers()),
             'busy': len(app.get_busy_workers()),
             'dead': len(app.get_dead_workers()),
+            'target': app.n_workers,
+            'throughput': app.state.throughput,
+            'ratelimit': app.governor.rate or None,
+        },
+        'informs': {
+            'sent': app.inform_counters[SENT],
+            'merged': app.inform_counters[MERGED],
+        },
+        'postprocessing': {
+            'queued': app.queue.depth(POSTPROCESS),
+            'busy': len([w for w in app.postprocessors if w.busy.value and w.is_alive()]),
+            'done': int(app.postprocess_stats[0]),
+            'seconds': app.postprocess_stats[1],
         },
     }
 
 
+@app.route('/state/stream', method='GET')
+def state_stream():
+    """Server-Sent Events: one event per coalesced burst of changes"""
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    since = request.headers.get('Last-Event-ID') or request.query.get('since')
+    try:
+        version = int(since) if since is not None else None
+    except ValueError:
+        version = None
+    try:
+        fields = requested_fields()
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+
+    def stream():
+        # tell EventSource to reconnect quickly after a server restart
+        yield "retry: 1000\n\n"
+        changes = None if version is None else app.state.since(version, fields)
+        while True:
+            payload = state_payload(changes, fields)
+            yield "id: {}\ndata: {}\n\n".format(payload['version'], json.dumps(payload))
+            changes = app.hub.wait(payload['version'], timeout=HEARTBEAT, fields=fields)
+
+    return stream()
+
+
 @app.route('/q', method='POST')
 def q_put():
-    url = request.forms.get('url')
-    filter = request.forms.get('filter')
-    indexes = request.forms.get('indexes') or None
-    if url:
-        app.queue.put(Task(url, title_filter=filter, index_filter=indexes))
+    """Queue one url from the form, or many from a JSON array or newline separated body"""
+    try:
+        items = submitted_items()
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    if items is None:
+        url = request.forms.get('url')
+        try:
+            task = task_for(
+                url,
+                filter=request.forms.get('filter'),
+                indexes=request.forms.get('indexes'),
+                priority=request.forms.get('priority'),
+            )
+        except ValueError as e:
+            return {"success": False, "url": url, "error": str(e)}
+        id_ = app.queue.put(task)
         print("Added url " + url + " to the download queue")
-        return {"success": True, "url": url , 'filter': filter}
-    else:
-        return {"success": False, "error": "dl called without a url" }
+        return {"success": True, "url": url, 'filter': task.title_filter, 'id': id_, 'merged': task.merged}
+
+    results = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'url': item}
+        if not isinstance(item, dict):
+            results.append({"success": False, "url": None, "error": "items have to be urls or objects"})
+            continue
+        url = item.get('url')
+        try:
+            task = task_for(url, item.get('filter'), item.get('indexes'), item.get('priority'))
+        except ValueError as e:
+            results.append({"success": False, "url": url, "error": str(e)})
+        else:
+            results.append(task)
+    tasks = [r for r in results if isinstance(r, Task)]
+    # a url given twice is merged into the job of its first occurrence
+    app.queue.put_many(tasks)
+    print("Added {} urls to the download queue".format(len(tasks)))
+    results = [
+        {"success": True, "url": r.url, "id": r.id, "merged": r.merged} if isinstance(r, Task) else r
+        for r in results
+    ]
+    return {"success": True, "accepted": len(tasks), "rejected": len(results) - len(tasks), "results": results}
+
+
+def submitted_items():
+    """The items of a bulk submission, None for a single url from the form"""
+    content_type = request.content_type.split(';')[0].strip()
+    if content_type == 'application/json':
+        try:
+            items = json.loads(request.body.read().decode('utf-8'))
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array of urls or objects")
+        return items
+    if content_type == 'text/plain':
+        # also what wsgiref makes of a POST without a body
+        lines = request.body.read().decode('utf-8').splitlines()
+        return [line.strip() for line in lines if line.strip()] or None
+    return None
+
+
+def task_for(url, filter=None, indexes=None, priority=None):
+    """The task for a submitted url, raises ValueError if it can not be queued"""
+    if not url or not isinstance(url, str):
+        raise ValueError("dl called without a url")
+    if filter is not None and not isinstance(filter, str):
+        raise ValueError("filter has to be a string")
+    try:
+        priority = int(priority or PRIORITY)
+    except (TypeError, ValueError):
+        raise ValueError("priority has to be a number")
+    try:
+        # which video a new url is is only looked up by the analysers, see `YTWorker.investigate`
+        task = Task(url, title_filter=filter, index_filter=indexes or None, key=app.queue.key_of(url),
+                    priority=priority)
+    except (AttributeError, ValueError):
+        raise ValueError("indexes have to be a list of numbers and ranges like 1,3-5")
+    if task.key is not None and task.key in app.archive:
+        raise ValueError("already downloaded")
+    return task
 
 
 def run():
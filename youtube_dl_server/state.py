@@ -0,0 +1,247 @@
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
+import heapq
+from itertools import islice
+from threading import RLock
+import time
+
+from youtube_dl_server.utils import maybe_remove
+
+# what the UI and the API need of a task, the full info stays in the job store
+FIELDS = (
+    'status', 'title', 'thumbnail', 'updated_at',
+    'id', 'extractor', 'playlist', 'playlist_index',
+    'filename', 'tmpfilename', 'downloaded_bytes', 'total_bytes', 'speed', 'eta',
+    '_percent_str', '_speed_str', '_eta_str', '_total_bytes_str',
+    'ratelimit',
+)
+# what the web UI shows, /state sends only these unless asked for others
+DEFAULT_FIELDS = (
+    'status', 'title', 'thumbnail', 'updated_at', '_percent_str', '_speed_str', '_total_bytes_str',
+)
+FINISHED = ('done', 'error')
+
+
+def compact(item):
+    return {key: item[key] for key in FIELDS if key in item}
+
+
+class Record:
+    """The state of one task, only the `FIELDS` of the info are kept"""
+
+    __slots__ = FIELDS
+
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, field, None)
+
+    def update(self, item):
+        if self._total_bytes_str is not None:
+            maybe_remove(item, '_total_bytes_str')
+        for key, value in compact(item).items():
+            setattr(self, key, value)
+
+    def as_dict(self, fields=FIELDS):
+        d = {}
+        for field in fields:
+            value = getattr(self, field)
+            if value is not None:
+                d[field] = value
+        return d
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+
+class StatusIndex:
+    """The urls of the entries by status, in the order they got it.
+
+    Every url gets the next sequence number when it enters a status, so a
+    page of one or more statuses continues after the last number it ended
+    with and entries moving around do not shift the pages.
+    """
+
+    def __init__(self):
+        # status -> sequence numbers of its urls, ascending
+        self._seqs = {}
+        self._urls = {}
+        # url -> (status, sequence number)
+        self._entered = {}
+        self._next = 0
+
+    def move(self, url, status):
+        entered = self._entered.get(url)
+        if entered is not None and entered[0] == status:
+            return
+        self.remove(url)
+        self._next += 1
+        self._seqs.setdefault(status, []).append(self._next)
+        self._urls[self._next] = url
+        self._entered[url] = (status, self._next)
+
+    def remove(self, url):
+        entered = self._entered.pop(url, None)
+        if entered is None:
+            return
+        status, seq = entered
+        seqs = self._seqs[status]
+        del seqs[bisect_left(seqs, seq)]
+        del self._urls[seq]
+
+    def count(self, statuses):
+        return sum(len(self._seqs.get(status, ())) for status in statuses)
+
+    def page(self, statuses, after=0, limit=None):
+        """The urls with one of the `statuses` that entered it after `after`,
+        at most `limit`, and where the next page starts or None if this is the last
+        """
+        tails = []
+        for status in statuses:
+            seqs = self._seqs.get(status)
+            if seqs:
+                # without copying or walking what comes before
+                tails.append(map(seqs.__getitem__, range(bisect_right(seqs, after), len(seqs))))
+        seqs = list(islice(heapq.merge(*tails), None if limit is None else limit + 1))
+        cursor = None
+        if limit is not None and len(seqs) > limit:
+            seqs = seqs[:limit]
+            cursor = seqs[-1] if seqs else after
+        return [self._urls[seq] for seq in seqs], cursor
+
+    @property
+    def statuses(self):
+        return list(self._seqs)
+
+
+class State:
+    """Task states keyed by url with a monotonically increasing change version.
+
+    Lives in the server process only, workers send their updates as events
+    which are applied here (see `Hub`). Every update and delete bumps the
+    version, entries remember the version of their last change and deletes
+    leave a tombstone so clients can ask for everything that changed after a
+    version they have already seen.
+
+    Versions go on from the microseconds since the epoch at the start, so the
+    version of an earlier run is either before the first of ours or after the
+    last and clients asking with it start over.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.version = time.time_ns() // 1000
+        # url -> version of the last change, oldest change first
+        self._versions = OrderedDict()
+        self._deleted = OrderedDict()
+        # tombstones up to this version are forgotten
+        self._horizon = self.version
+        # url -> bytes/s of the running downloads
+        self._speeds = {}
+        self._index = StatusIndex()
+        self._lock = RLock()
+
+    def update(self, url, item):
+        with self._lock:
+            self.version += 1
+            record = self.entries.get(url)
+            if record is None:
+                record = self.entries[url] = Record()
+            record.update(item)
+            # the UI shows entries without status as pending
+            self._index.move(url, record.status or 'pending')
+            if record.status == 'downloading' and record.speed:
+                self._speeds[url] = record.speed
+            else:
+                self._speeds.pop(url, None)
+            self._touch(self._versions, url)
+            self._deleted.pop(url, None)
+
+    def delete(self, url):
+        with self._lock:
+            self.version += 1
+            self.entries.pop(url, None)
+            self._index.remove(url)
+            self._speeds.pop(url, None)
+            self._versions.pop(url, None)
+            self._touch(self._deleted, url)
+
+    def _touch(self, versions, url):
+        versions[url] = self.version
+        versions.move_to_end(url)
+
+    @property
+    def throughput(self):
+        """Bytes/s of all running downloads together"""
+        with self._lock:
+            return sum(self._speeds.values())
+
+    def snapshot(self, fields=FIELDS):
+        with self._lock:
+            entries = {url: record.as_dict(fields) for url, record in self.entries.items()}
+            return self.version, entries, []
+
+    def page(self, statuses=None, cursor=0, limit=None, fields=FIELDS):
+        """The current version, the `fields` of up to `limit` entries with one of the `statuses`
+        (all if None) after `cursor`, the cursor of the next page and how many there are in total
+        """
+        with self._lock:
+            if statuses is None:
+                statuses = self._index.statuses
+            urls, cursor = self._index.page(statuses, cursor, limit)
+            entries = {url: self.entries[url].as_dict(fields) for url in urls}
+            return self.version, entries, cursor, self._index.count(statuses)
+
+    def since(self, version, fields=FIELDS):
+        """Return the current version, the `fields` of the entries changed and the urls deleted after `version`"""
+        with self._lock:
+            if version > self.version or version < self._horizon:
+                # we restarted in the mean time or forgot what was deleted,
+                # the client has to start over
+                return None
+            changed = {
+                url: self.entries[url].as_dict(fields)
+                for url in self._newer(self._versions, version)
+            }
+            deleted = list(self._newer(self._deleted, version))
+            return self.version, changed, deleted
+
+    def records(self, urls):
+        """The dicts of those of `urls` that were not deleted"""
+        with self._lock:
+            return {url: self.entries[url].as_dict() for url in urls if url in self.entries}
+
+    def evict(self, ttl, max_entries):
+        """Delete finished entries older than `ttl` seconds and the least recently
+        changed finished ones above `max_entries`. Returns the deleted urls.
+        """
+        with self._lock:
+            expired_before = time.time() - ttl
+            excess = len(self.entries) - max_entries
+            evicted = []
+            for url in self._versions:
+                record = self.entries[url]
+                expired = (record.updated_at or 0) < expired_before
+                if not expired and excess <= 0:
+                    break
+                if record.finished:
+                    evicted.append(url)
+                    excess -= 1
+            for url in evicted:
+                self.delete(url)
+            while len(self._deleted) > max_entries:
+                _, self._horizon = self._deleted.popitem(last=False)
+            return evicted
+
+    def _newer(self, versions, version):
+        for url, v in reversed(versions.items()):
+            if v <= version:
+                break
+            yield url
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def __getitem__(self, url):
+        return self.entries[url]
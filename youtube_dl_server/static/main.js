@@ -1,101 +1,157 @@
-var templates = {}
-// from https://stackoverflow.com/a/7616484
-String.prototype.hashCode = function() {
-  var hash = 0, i, chr;
-  if (this.length === 0) return hash;
-  for (i = 0; i < this.length; i++) {
-    chr   = this.charCodeAt(i);
-    hash  = ((hash << 5) - hash) + chr;
-    hash |= 0; // Convert to 32bit integer
-  }
-  return hash;
-};
-
-
 var template;
+// every row is this high, see main.css
+var ROW_HEIGHT = 88;
+// rows rendered above and below those in sight
+var OVERSCAN = 5;
 var status_class_map = {
     'downloading': '',
     'analysing': '',
     'finished': '',
+    'postprocessing': '',
     'pending': '',
     'error': 'bg-danger',
 };
-function new_entry(id, item){
+
+// url -> item, and the urls of every list in the order they got there
+var entries = {};
+var lists = {pending: [], downloading: [], done: []};
+
+function list_of(status){
+    if(status == 'downloading' || status == 'finished' || status == 'postprocessing')
+        return 'downloading';
+    if(status == 'done' || status == 'error')
+        return 'done';
+    return 'pending';
+}
+
+function remove_from(name, url){
+    var urls = lists[name];
+    var i = urls.indexOf(url);
+    if(i != -1)
+        urls.splice(i, 1);
+}
+
+function new_entry(url, index){
+    var item = $.extend({}, entries[url]);
+    if(item.status === undefined)
+        item.status = 'pending';
+    item.url = url;
+    item.top = index * ROW_HEIGHT;
     item.class = status_class_map[item.status];
-    var inner = template(item);
-    return inner;
+    item.width = '100%';
+    item.animate = 'progress-bar-striped progress-bar-animated';
+    if(item.status == 'downloading'){
+        item.width = item._percent_str;
+        item.animate = '';
+    } else if(item.status == 'analysing'){
+        item.width = item._percent_str || '100%';
+    } else if(item.status == 'finished' || item.status == 'postprocessing'){
+        // transcoding / ffmpeg
+        item.class += ' bg-success';
+    }
+    return template(item);
 }
 
-function sort(){
-    $("ul.done").each(function(){
-        $(this).html($(this).children('li').sort(function(a, b){
-            return ($(b).data('at')) < ($(a).data('at')) ? -1 : 1;
-        }));
-    });
+// only the rows in sight are in the DOM, the list is as high as all of them
+function render(name){
+    var ul = $('ul.' + name);
+    var scroller = ul.parent()[0];
+    var urls = lists[name];
+    var first = Math.max(0, Math.floor(scroller.scrollTop / ROW_HEIGHT) - OVERSCAN);
+    var last = Math.min(urls.length, Math.ceil((scroller.scrollTop + scroller.clientHeight) / ROW_HEIGHT) + OVERSCAN);
+    var html = '';
+    for(var i = first; i < last; i++)
+        html += new_entry(urls[i], i);
+    ul.css('height', urls.length * ROW_HEIGHT).html(html);
 }
 
-function poll_state(){
-    $.getJSON('state', function(resp){
-        $('#idle').text(resp.workers.idle);
-        $('#busy').text(resp.workers.busy);
+// lists are rendered once per frame however many changes come in
+var dirty = {};
+function invalidate(name){
+    if($.isEmptyObject(dirty))
+        window.requestAnimationFrame(function(){
+            for(var list in dirty)
+                render(list);
+            dirty = {};
+        });
+    dirty[name] = true;
+}
+
+var version = null;
+function apply_state(resp){
+    $('#idle').text(resp.workers.idle);
+    $('#busy').text(resp.workers.busy);
+    version = resp.version;
 
-        var state = resp.state;
-        $('li.item').addClass('old');
-        for(url in state){
-            if (!state.hasOwnProperty(url))
-                continue;
-            var id = url.hashCode();
-            var item = state[url];
-            item.id = id;
-            item.url = url;
-            if(item.status == 'downloading' || item.status == 'finished'){
-                var entry = $('ul.downloading .' + id);
-                $('ul.pending li.' + id).remove();
-                if(entry.length == 0)
-                    $('ul.downloading').append(new_entry(id, item));
-                else
-                    entry.removeClass('old');
-                var animate_classes = 'progress-bar-striped progress-bar-animated';
-                var bar = $('.progress-bar', entry);
-                if (item.status == 'downloading') {
-                    bar.removeClass(animate_classes).width(item._percent_str);
-                } else { // finished aka transcoding / ffmpeg
-                    bar.addClass(animate_classes + ' bg-success')
-                    .width('100%');
-                }
-                $('.speed', entry).text(item._speed_str);
-            } else if(item.status == 'done' || item.status == 'error') {
-                $('ul.downloading li.' + id).remove();
-                $('ul.pending li.' + id).remove();
-                var entry = $('ul.done .' + id);
-                if(entry.length == 0)
-                    $('ul.done').append(new_entry(id, item));
-                else
-                    entry.removeClass('old');
-            } else {
-                var entry = $('ul.pending .' + id);
-                if(item.status === undefined)
-                    item.status = 'pending';
-                if(entry.length == 0)
-                    $('ul.pending').append(new_entry(id, item));
-                else{
-                    if(item.status == 'analysing'){
-                        $('.progress-bar', entry).width(item._percent_str);
-                    }
-                    entry.removeClass('old');
-                }
+    if(resp.full){
+        entries = {};
+        lists = {pending: [], downloading: [], done: []};
+        for(var list in lists)
+            invalidate(list);
+    }
+    resp.deleted.forEach(function(url){
+        if(!entries.hasOwnProperty(url))
+            return;
+        var name = list_of(entries[url].status);
+        remove_from(name, url);
+        delete entries[url];
+        invalidate(name);
+    });
+    var state = resp.state;
+    for(var url in state){
+        if (!state.hasOwnProperty(url))
+            continue;
+        var item = state[url];
+        var name = list_of(item.status);
+        if(!entries.hasOwnProperty(url)){
+            lists[name].push(url);
+        } else {
+            var previous = list_of(entries[url].status);
+            if(previous != name){
+                remove_from(previous, url);
+                lists[name].push(url);
+                invalidate(previous);
             }
         }
-        $('li.item.old').remove();
-        //sort();
-    });
+        entries[url] = item;
+        invalidate(name);
+    }
+}
 
+// long poll fallback for browsers without EventSource
+function poll_state(){
+    var params = version === null ? {} : {since: version, wait: 30};
+    $.getJSON('state', params, apply_state)
+        .done(function(){ poll_state(); })
+        .fail(function(){ window.setTimeout(poll_state, 1000); });
+}
+
+function stream_state(){
+    var source = new EventSource('state/stream');
+    source.onmessage = function(e){
+        apply_state(JSON.parse(e.data));
+    };
+    source.onerror = function(){
+        // turned away, e.g. with a 503 while the server is busy, browsers give up on those
+        if(source.readyState == EventSource.CLOSED)
+            window.setTimeout(stream_state, 1000);
+    };
 }
 
 $(document).ready(function() {
-    window.setInterval(poll_state, 1000);
     var source   = document.getElementById("entry-template").innerHTML;
     template = Handlebars.compile(source);
+    if(window.EventSource)
+        stream_state();
+    else
+        poll_state();
+    $('.scroller').on('scroll', function(){
+        invalidate($(this).data('list'));
+    });
+    $(window).on('resize', function(){
+        for(var list in lists)
+            invalidate(list);
+    });
     $('.navbar form').submit(function(e){
         $('.popover .add-options input').each(function(){
             var t = $(this);
@@ -118,4 +174,4 @@ $(document).ready(function() {
         content: $('.add-options').clone(),
         html: true
     });
-});
\ No newline at end of file
+});
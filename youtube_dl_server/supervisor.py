@@ -0,0 +1,27 @@
+from threading import Event
+from threading import Thread
+import traceback
+
+
+class Supervisor(Thread):
+    """Looks after the workers every `interval` seconds, see `App.ensure_workers`.
+
+    Runs on its own so it neither waits for requests nor holds them up.
+    """
+
+    def __init__(self, app, interval=0.5):
+        super(Supervisor, self).__init__(daemon=True, name='supervisor')
+        self.app = app
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.app.ensure_workers()
+            except Exception:
+                # try again next time instead of leaving the workers alone
+                traceback.print_exc()
+
+    def stop(self):
+        self.stopped.set()
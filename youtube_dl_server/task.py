@@ -0,0 +1,115 @@
+from youtube_dl_server.archive import video_key
+from youtube_dl_server.utils import Ranges
+
+# job stages
+ANALYSE = 'analyse'
+DOWNLOAD = 'download'
+POSTPROCESS = 'postprocess'
+# lower goes first, entries of a playlist queue behind single videos
+PRIORITY = 0
+PLAYLIST_PRIORITY = 10
+
+
+class Task:
+    def __init__(self, url, info=None, title_filter=None, index_filter=None, extra=None, key=None,
+                 priority=PRIORITY, submission=None, postprocess=None, sync=False, id=None):
+        self.id = id
+        self.priority = priority
+        # id of the task that was submitted and led to this one
+        self.submission = submission
+        self.url = url
+        self.info = info or {}
+        # playlist context of an entry that still has to be resolved
+        self.extra = extra or {}
+        # what is left to do with the downloaded files, see `YoutubeDL.post_process`
+        self.postprocess = postprocess
+        # only list the playlist up to what we know already, see `YTWorker.sync`
+        self.sync = sync
+        # the video_key if we know it already
+        self.key = key or self._key()
+        # set by the job store when an equal task was queued already
+        self.merged = False
+        # set by the job store when the task is claimed
+        self.created_at = None
+        self.title_filter = title_filter
+        # as given, to store and restore the task
+        self.indexes = index_filter
+        self.index_filter = Ranges(index_filter) if index_filter is not None else None
+
+    def __str__(self):
+        return "<Task {s.id} {s.url}>".format(s=self)
+
+    def _key(self):
+        info = self.info or self.extra
+        extractor = info.get('extractor_key') or info.get('ie_key')
+        if extractor and info.get('id'):
+            return video_key(extractor, info['id'])
+
+    @property
+    def is_playlist(self):
+        return 'playlist' in self.url
+
+    @property
+    def investigate(self):
+        return not self.info
+
+    @property
+    def stage(self):
+        if self.postprocess:
+            return POSTPROCESS
+        return ANALYSE if self.investigate else DOWNLOAD
+
+    def child(self, url, priority=None, **kwargs):
+        """A task following from this one, it is part of the same submission"""
+        return Task(
+            url,
+            priority=self.priority if priority is None else priority,
+            submission=self.submission or self.id,
+            **kwargs
+        )
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'info': self.info,
+            'title_filter': self.title_filter,
+            'index_filter': self.indexes,
+            'extra': self.extra,
+            'key': self.key,
+            'priority': self.priority,
+            'submission': self.submission,
+            'postprocess': self.postprocess,
+            'sync': self.sync,
+        }
+
+    @classmethod
+    def from_dict(cls, d, id=None):
+        return cls(id=id, **d)
+
+    def new_for(self, info, url=None, priority=None):
+        if self.title_filter is not None and self.title_filter not in info['title']:
+            return
+        if self.index_filter is not None and info['playlist_index'] not in self.index_filter:
+            return
+        return self.child(url or info['webpage_url'], info=info, priority=priority)
+
+    def entry_for(self, entry, extra):
+        """A task resolving the flat listed playlist `entry`"""
+        title = entry.get('title')
+        if title is not None and self.title_filter is not None and self.title_filter not in title:
+            return
+        if self.index_filter is not None and extra['playlist_index'] not in self.index_filter:
+            return
+        extra['ie_key'] = entry.get('ie_key')
+        if entry.get('id') is not None:
+            extra['id'] = entry['id']
+        if title is not None:
+            extra['title'] = title
+        # without a title we can only filter once it is resolved
+        title_filter = self.title_filter if title is None else None
+        return self.child(
+            entry['url'],
+            title_filter=title_filter,
+            extra=extra,
+            priority=self.priority + PLAYLIST_PRIORITY,
+        )
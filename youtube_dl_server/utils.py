@@ -1,4 +1,6 @@
+from bisect import bisect_right
 from contextlib import contextmanager
+import time
 
 
 @contextmanager
@@ -18,3 +20,73 @@ def maybe_remove(d, *keys):
         except KeyError:
             pass
 
+
+class Ranges:
+    """Numbers given like 1,3-5 as sorted, merged `(first, last)` ranges.
+
+    Looking a number up bisects the ranges, so 1-100000 is one range and not
+    a hundred thousand numbers.
+    """
+
+    def __init__(self, spec):
+        ranges = []
+        for part in spec.split(','):
+            if '-' in part:
+                first, _, last = part.partition('-')
+                first, last = int(first), int(last)
+            else:
+                first = last = int(part)
+            # playlists count from 1
+            first = max(first, 1)
+            if first <= last:
+                ranges.append((first, last))
+        ranges.sort()
+        self.ranges = []
+        for first, last in ranges:
+            if self.ranges and first <= self.ranges[-1][1] + 1:
+                self.ranges[-1] = (self.ranges[-1][0], max(self.ranges[-1][1], last))
+            else:
+                self.ranges.append((first, last))
+        self._firsts = [first for first, _ in self.ranges]
+
+    @property
+    def last(self):
+        return self.ranges[-1][1] if self.ranges else 0
+
+    def __contains__(self, number):
+        if not isinstance(number, int):
+            return False
+        i = bisect_right(self._firsts, number) - 1
+        return i >= 0 and number <= self.ranges[i][1]
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in self.ranges)
+
+
+class Coalescer:
+    """Merges the progress updates of one url so at most one is sent per `interval` seconds.
+
+    Status changes are always passed through right away, together with
+    whatever was merged before them.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.status = None
+        self.sent_at = 0
+        self.pending = {}
+
+    def add(self, item):
+        """Return the item to send now or None if it was merged"""
+        status = item.get('status', self.status)
+        self.pending.update(item)
+        now = time.monotonic()
+        if status == self.status and now - self.sent_at < self.interval:
+            return None
+        self.status = status
+        self.sent_at = now
+        return self.flush()
+
+    def flush(self):
+        item, self.pending = self.pending, {}
+        return item
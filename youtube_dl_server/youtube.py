@@ -1,13 +1,24 @@
+import cProfile
 from datetime import datetime
-from multiprocessing import Process
 import os
 import re
+import time
 
-import youtube_dl as ydl
-from youtube_dl.utils import UnavailableVideoError
-from youtube_dl import YoutubeDL as YoutubeDL_
-
+from youtube_dl_server.archive import video_key
+from youtube_dl_server.bandwidth import Limiter
+from youtube_dl_server.jobs import DONE
+from youtube_dl_server.jobs import ERROR
+from youtube_dl_server.processes import Event
+from youtube_dl_server.processes import Process
+from youtube_dl_server.processes import Value
+from youtube_dl_server.state import compact
+from youtube_dl_server.state import FINISHED
+from youtube_dl_server.task import ANALYSE
+from youtube_dl_server.task import DOWNLOAD
+from youtube_dl_server.task import PLAYLIST_PRIORITY
+from youtube_dl_server.task import POSTPROCESS
 from youtube_dl_server.utils import attribute
+from youtube_dl_server.utils import Coalescer
 from youtube_dl_server.utils import maybe_remove
 
 #DEFAULT_TEMPLATE = "%(title)s.%(ext)s"
@@ -21,89 +32,50 @@ from youtube_dl_server.utils import maybe_remove
 The uploader/Channel will become a collection, The playlist a series, The files episodes.
 """
 DEFAULT_TEMPLATE = "%(playlist)s [%(playlist_id)s]/%(title)s [%(id)s].%(ext)s"
-
-
-class YoutubeDL(YoutubeDL_):
-    def download(self, url_list, extra=None):
-        """Download a given list of URLs."""
-        extra = extra or {}
-        outtmpl = self.params.get('outtmpl', ydl.DEFAULT_OUTTMPL)
-        if (len(url_list) > 1 and
-                outtmpl != '-' and
-                '%' not in outtmpl and
-                self.params.get('max_downloads') != 1):
-            raise ydl.SameFileError(outtmpl)
-
-        out = []
-        for url in url_list:
-            try:
-                # It also downloads the videos
-                res = self.extract_info(
-                    url,
-                    force_generic_extractor=self.params.get('force_generic_extractor', False),
-                    extra_info=extra,
-                )
-            except UnavailableVideoError:
-                self.report_error('unable to download video')
-                raise
-            except ydl.MaxDownloadsReached:
-                self.to_screen('[info] Maximum number of downloaded files reached.')
-                raise
-            else:
-                if self.params.get('dump_single_json', False):
-                    out.append(res)
-
-        return out
-
-
-class Task:
-    def __init__(self, url, info=None, title_filter=None, index_filter=None):
-        self.url = url
-        self.info = info or {}
-        self.title_filter = title_filter
-        self.index_filter = index_filter
-        if index_filter is not None:
-            filter_ = set()
-            for i in index_filter.split(','):
-                if '-' in i:
-                    begin, _, end = i.partition('-')
-                    filter_.update(range(int(begin), int(end) + 1))
-                else:
-                    filter_.add(int(i))
-
-            self.index_filter = filter_
-
-    @property
-    def is_playlist(self):
-        return 'playlist' in self.url
-
-    @property
-    def investigate(self):
-        return not self.info
-
-    @classmethod
-    def from_info(cls, info):
-        return cls(info['webpage_url'], info=info)
-
-    def new_for(self, info):
-        if self.title_filter is not None and self.title_filter not in info['title']:
-            return
-        if self.index_filter is not None and info['playlist_index'] not in self.index_filter:
-            return
-        return Task.from_info(info)
+# indexes into the informs counters shared by all workers
+SENT, MERGED = 0, 1
 
 
 class YTWorker(Process):
 
-    def __init__(self, queue, state, template=DEFAULT_TEMPLATE ,download=True, proxy=None, *args, **kwargs):
+    def __init__(self, queue, events, busy, counters, cache, archive, template=DEFAULT_TEMPLATE ,download=True,
+                 inform_interval=0.25, rebalance=None, postprocess=False, postprocess_stats=None, metrics=None,
+                 profile_dir=None, sync_stop=10, *args, **kwargs):
         super(YTWorker, self).__init__(*args, **kwargs)
         self.queue = queue
-        self.state = state
+        self.events = events
+        self.cache = cache
+        self.archive = archive
+        # shared with all workers: [informs sent, informs merged]
+        self.counters = counters
+        self.inform_interval = inform_interval
+        self._coalescers = {}
+        # the task we got from the queue and when we claimed it
+        self._claimed = None
+        self._started = None
         self.should_download = download
+        self.should_postprocess = postprocess
+        # shared with all post processors: [jobs done, seconds spent]
+        self.postprocess_stats = postprocess_stats
+        self.metrics = metrics
+        # a cProfile dump is written there for every task
+        self.profile_dir = profile_dir
+        # a sync stops after this many known entries in a row
+        self.sync_stop = sync_stop
+        # of the claimed task, for its timeline
+        self._status = None
+        self.started_at = None
         self.out_template = template
         self.task = None
-        self.proxy = proxy
-        self.proxy.busy = False
+        self.busy = busy
+        self.busy.value = False
+        # set to stop once the current task is done
+        self.stopping = Event()
+        # bytes/s the governor gives us, 0 is unlimited, and the priority it goes by
+        self.rate = Value('d', 0)
+        self.priority = Value('i', 0)
+        # set to have the bandwidth shared out again
+        self.rebalance = rebalance
 
     @property
     def url(self):
@@ -111,57 +83,308 @@ class YTWorker(Process):
 
     def __str__(self):
         s = super(YTWorker, self).__str__()
-        type_ = "downloader" if self.should_download else "info getter"
+        if self.should_postprocess:
+            type_ = "post processor"
+        else:
+            type_ = "downloader" if self.should_download else "info getter"
         return "{} {}".format(s, type_)
 
+    @property
+    def stages(self):
+        if self.should_postprocess:
+            return (POSTPROCESS,)
+        return (DOWNLOAD,) if self.should_download else (ANALYSE,)
+
+    def start(self):
+        self.started_at = time.time()
+        super(YTWorker, self).start()
+
     def run(self):
+        if self.metrics is not None:
+            self.metrics.observe('ytdl_worker_start_seconds', time.time() - self.started_at)
         print("Started {}".format(self))
-        while True:
-            self.task = self.queue.get()
-            self.proxy.busy = True
+        while not self.stopping.is_set():
+            self.task = self.queue.get(self.name, self.stages, self.stopping)
+            if self.task is None:
+                break
+            self._claimed = (self.task, time.monotonic())
+            self._started = time.monotonic()
+            self._status = None
+            if self.metrics is not None and self.task.created_at is not None:
+                self.metrics.observe(
+                    'ytdl_queue_wait_seconds', max(0, time.time() - self.task.created_at), stage=self.task.stage,
+                )
+            self.priority.value = self.task.priority
+            self.busy.value = True
+            self.rebalanced()
             try:
-                if self.task.investigate:
-                    self.investigate(self.task)
-                elif self.should_download:
-                    self.download(self.task)
-                else:
-                    print(f"re queueing ... but why? {self.task}")
-                    self.queue.put(self.task)
+                self.work(self.task)
             except:
                 self.inform({'status': 'error'})
+                self.queue.finish(self.task, ERROR)
+                self.measure(ERROR)
                 raise
             else:
-                self.proxy.busy = False
+                self.queue.finish(self.task, DONE)
+                self.measure(DONE)
+                self.busy.value = False
+                self.rebalanced()
             finally:
-                self.queue.task_done()
+                self.flush()
+        print("Stopped {}".format(self))
+
+    def work(self, task):
+        if not self.profile_dir:
+            return self._work(task)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self._work, task)
+        finally:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.profile_dir, '{}-{}.prof'.format(task.id, task.stage)))
+
+    def _work(self, task):
+        if task.postprocess:
+            self.postprocess(task)
+        elif task.sync:
+            self.sync(task)
+        elif task.investigate:
+            self.investigate(task)
+        else:
+            self.download(task)
+
+    def transition(self, status):
+        """Note a new status of the claimed task in its timeline, the job store notes when it is finished"""
+        if status is None or status == self._status or status in FINISHED:
+            return
+        if self._claimed is None or self.task is not self._claimed[0]:
+            # informing about a task that follows from ours
+            return
+        self._status = status
+        self.queue.mark(self.task, status, self.name)
+
+    def measure(self, status):
+        """Count the task we claimed as finished with `status`"""
+        if self.metrics is None:
+            return
+        self.metrics.observe('ytdl_task_seconds', time.monotonic() - self._started, stage=self.task.stage)
+        self.metrics.count('ytdl_tasks_total', stage=self.task.stage, status=status)
+
+    def count_bytes(self):
+        """A progress hook counting the downloaded bytes"""
+        last = 0
+
+        def hook(d):
+            nonlocal last
+            downloaded = d.get('downloaded_bytes')
+            if downloaded is None:
+                return
+            # a new file starts at 0 again
+            new = downloaded - last if downloaded >= last else downloaded
+            last = downloaded
+            if new:
+                self.metrics.count('ytdl_downloaded_bytes_total', new)
+        return hook
+
+    def rebalanced(self):
+        if self.rebalance is not None and self.should_download and not self.should_postprocess:
+            self.rebalance.set()
+
+    def throttle(self):
+        """A progress hook keeping the download at the rate the governor gives us.
+
+        youtube-dl's own ratelimit can not follow a rate that changes, see `Limiter`.
+        """
+        limiter = Limiter()
+        last = None
+
+        def hook(d):
+            nonlocal last
+            d['ratelimit'] = self.rate.value or None
+            downloaded = d.get('downloaded_bytes')
+            if downloaded is None:
+                return
+            if last is None or downloaded < last:
+                # a new file, maybe continued from what was downloaded before
+                last = downloaded
+                return
+            new, last = downloaded - last, downloaded
+            limiter.take(new, lambda: self.rate.value or None)
+        return hook
 
     def investigate(self, task):
-        entries = self.get_info(task)
-        for info in entries:
-            t = task.new_for(info)
-            if t is None:
-                continue
+        if task.key is None and task.submission is None:
+            # the server queues submitted urls without knowing which video they are
+            from youtube_dl_server.ytdl import url_key
+            task.key = url_key(task.url)
+            if task.key is not None:
+                # other forms of the url find it from now on
+                self.queue.resolved(task)
+                if task.key in self.archive:
+                    self.transition('archived')
+                    self.inform({'status': 'done'})
+                    return
+                if self.queue.busy([task.key], task):
+                    # the job working on it tells about it
+                    self.transition('merged')
+                    return
+        info = self.get_info(task)
+        if 'entries' in info:
+            tasks = self.list_entries(task, info)
+        else:
+            # entries of a playlist keep the url they were listed with
+            video = task.new_for(info, url=task.url if task.extra else None)
+            if video is None:
+                # the filters only dropped it once resolved, nothing is downloaded for it
+                return self.forget()
+            tasks = [video]
+        self.enqueue(task, tasks)
+
+    def enqueue(self, task, tasks, synced=None):
+        """Queue the `tasks` following from `task`, but not those of videos that were downloaded
+        already or are queued or worked on for another submission. `synced` goes on to `put_many`.
+        """
+        # downloaded already, without resolving it (again)
+        tasks = [t for t in tasks if t is not None and t.key not in self.archive]
+        # what follows from our own submission, like the download of the video we analyse, goes on
+        busy = self.queue.busy({t.key for t in tasks if t.key is not None}, task)
+        elsewhere = {t.url for t in tasks if t.key in busy}
+        tasks = [t for t in tasks if t.key not in busy]
+        for t in tasks:
+            if t.investigate:
+                item = {'status': 'pending', 'title': t.extra.get('title', t.url), 'thumbnail': ''}
+            else:
+                maybe_remove(t.info, 'formats', 'requested_formats', 'tags')
+                item = dict(t.info, status='pending')
             with attribute(self, 'task', t):
-                self.inform(t.info)
-            self.queue.put(t)
+                self.inform(item)
+        self.queue.put_many(tasks, synced=synced)
+        # the job working on it tells about it
+        if task.url not in {t.url for t in tasks} | elsewhere:
+            self.inform({'status': 'done'})
+
+    def sync(self, task):
+        """Queue the entries of the playlist that are newer than those we know.
+
+        Entries are expected newest first, like the uploads of a channel, and
+        are only listed until the newest entry the last sync saw or until
+        `sync_stop` entries in a row were known already.
+        """
+        from youtube_dl_server.ytdl import iter_entries
+        from youtube_dl_server.ytdl import YoutubeDL
+        self.inform({'status': 'analysing', 'title': task.extra.get('title', self.url), 'thumbnail': ''})
+        mark = self.queue.high_water_mark(task.url)
+        entries = []
+        newest = None
+        known = 0
+        with YoutubeDL({'quiet': True, 'call_home': False}) as ydl:
+            playlist = ydl.unprocessed(task.url)
+            if 'entries' not in playlist:
+                # a single video, nothing to sync
+                return self.investigate(task)
+            for index, entry in enumerate(iter_entries(playlist['entries']), 1):
+                if newest is None:
+                    newest = entry.get('id')
+                if mark is not None and entry.get('id') == mark:
+                    break
+                if entry.get('_type', 'video') == 'video':
+                    # not resolved without processing, it is resolved on its own like the others
+                    if not entry.get('webpage_url'):
+                        continue
+                    entry = {
+                        '_type': 'url', 'url': entry['webpage_url'], 'ie_key': entry.get('extractor_key'),
+                        'id': entry.get('id'), 'title': entry.get('title'),
+                    }
+                if self.known(entry):
+                    known += 1
+                    if known >= self.sync_stop:
+                        break
+                    continue
+                known = 0
+                entries.append((index, entry))
+        print("Sync of {} found {} new entries".format(self.url, len(entries)))
+        self.enqueue(task, self.list_entries(task, playlist, entries), synced=(task.url, newest))
+
+    def known(self, entry):
+        """Whether the video of the flat playlist `entry` was downloaded or queued before"""
+        if not entry.get('ie_key') or entry.get('id') is None:
+            return False
+        key = video_key(entry['ie_key'], entry['id'])
+        return key in self.archive or self.queue.known(key)
+
+    def list_entries(self, task, playlist, entries=None):
+        """Tasks for the `(index, entry)`s of a flat listed playlist, all of them by default,
+        each is resolved on its own
+        """
+        n_entries = None
+        if entries is None:
+            # filtered by index already they know theirs
+            entries = [(entry.get('playlist_index') or i, entry) for i, entry in enumerate(playlist['entries'], 1)]
+            n_entries = len(entries)
+        context = {
+            'playlist': playlist.get('title') or playlist.get('id'),
+            'playlist_id': playlist.get('id'),
+            'playlist_title': playlist.get('title'),
+            'playlist_uploader': playlist.get('uploader'),
+            'playlist_uploader_id': playlist.get('uploader_id'),
+            'n_entries': n_entries,
+        }
+        tasks = []
+        for index, entry in entries:
+            if entry.get('_type', 'video') == 'video':
+                # the extractor resolved it already
+                tasks.append(task.new_for(entry, priority=task.priority + PLAYLIST_PRIORITY))
+            else:
+                tasks.append(task.entry_for(entry, dict(context, playlist_index=index)))
+        return tasks
 
     def inform(self, item=None):
         item['updated_at'] = datetime.now().timestamp()
         #print("Inform {s._url} status {status}".format(s=self, status=item.get('status')))
-        maybe_remove(item, 'formats', 'requested_formats', 'tags')
-
-        if self.url in self.state:
-            state = self.state[self.url]
-            if '_total_bytes_str' in state:
-                maybe_remove(item, '_total_bytes_str')
-            # seams like this dict proxi does not like a direct update
-            state.update(item)
-            self.state[self.url] = state
-        else:
-            self.state[self.url] = item
+        item = compact(item)
+        self.transition(item.get('status'))
+        coalescer = self._coalescers.get(self.url)
+        if coalescer is None:
+            coalescer = self._coalescers[self.url] = Coalescer(self.inform_interval)
+        item = coalescer.add(item)
+        if item is None:
+            with self.counters.get_lock():
+                self.counters[MERGED] += 1
+            return
+        self._send(self.url, item)
+
+    def forget(self):
+        """Delete the entry of our url from the state"""
+        self._coalescers.pop(self.url, None)
+        self._send(self.url, None)
+
+    def _send(self, url, item):
+        with self.counters.get_lock():
+            self.counters[SENT] += 1
+        self.renew()
+        # the server merges it into the state of the url
+        self.events.put((url, item))
+
+    def flush(self):
+        """Send what is still merged for the urls of the last task"""
+        for url, coalescer in self._coalescers.items():
+            item = coalescer.flush()
+            if item:
+                self._send(url, item)
+        self._coalescers = {}
+
+    def renew(self):
+        """Keep our claim on the task alive while we are still working on it"""
+        task, claimed_at = self._claimed
+        now = time.monotonic()
+        if now - claimed_at > self.queue.claim_timeout / 2:
+            self.queue.renew(task)
+            self._claimed = (task, now)
 
     def get_info(self, task):
-        self.inform({'status': 'analysing', 'title': self.url, 'thumbnail': ''})
+        # the fork server we were started from imported it already
+        from youtube_dl_server.ytdl import YoutubeDL
+        self.inform({'status': 'analysing', 'title': task.extra.get('title', self.url), 'thumbnail': ''})
         # [download] Downloading video 4 of 16
         pattern = re.compile("video (?P<index>\d+) of (?P<total>\d+)")
 
@@ -180,24 +403,33 @@ class YTWorker(Process):
             'skip_download': True,
             'dump_single_json': True,
             'call_home': False,
+            # playlists are only listed, their entries are resolved as tasks of their own
+            'extract_flat': 'in_playlist',
         }
-        with YoutubeDL(ydl_opts) as ydl:
-            r = ydl.download([task.url])
-
-        self.inform({'status': 'done'})
-        # we only gibe youtube-dl one url
-        r = r[0]
-        if 'entries' in r:
-            r = r['entries']
-        else:
-            r = [r]
+        # the filters are applied while listing the playlist, `Task.entry_for` checks them exactly
+        if task.index_filter is not None:
+            ydl_opts['playlist_ranges'] = task.index_filter
+        if task.title_filter is not None:
+            ydl_opts['matchtitle'] = re.escape(task.title_filter)
+        extra = dict(task.extra)
+        ie_key = extra.pop('ie_key', None)
+        r = self.cache.get(task.url, task.key)
+        if r is None:
+            with YoutubeDL(ydl_opts) as ydl:
+                # we only gibe youtube-dl one url
+                r = ydl.download([task.url], ie_key=ie_key)[0]
+            if 'entries' not in r:
+                # without the playlist context, it is not cached for this playlist only
+                self.cache.put(r, task.url)
+        YoutubeDL.add_extra_info(r, extra)
         return r
 
     def download(self, task):
+        # the fork server we were started from imported it already
+        from youtube_dl_server.ytdl import YoutubeDL
         ydl_opts = {
             'skip_download': os.environ.get('YTDL_SKIPDL', False),
             'quiet': True,
-            'progress_hooks': [self.inform],
             'dump_single_json': True,
             'call_home': False,
             'outtmpl': self.out_template,
@@ -205,11 +437,58 @@ class YTWorker(Process):
             'writethumbnail': True,
             'cachedir': '/tmp',
             'merge_output_format': 'mp4',
-            'download_archive': 'downloads/history.txt',
+            'download_archive': self.archive.path,
+            # pick up the .part files of a download that crashed or was cut short by a restart
+            'continuedl': True,
+            # video and audio of a merged format at the same time
+            'concurrent_formats': bool(os.environ.get('YTDL_CONCURRENT_FORMATS', False)),
+            # merging is left to the post processors, we go on with the next download
+            'defer_postprocessing': True,
         }
         print("Starting download of " + self.url)
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download([task.url], extra=task.info)
+        ie_key = task.info.get('extractor_key')
+        info = self.cache.get(task.url, task.key)
+        with YoutubeDL(ydl_opts, archive=self.archive) as ydl:
+            # called for every block, also of fragments and of formats fetched at the same time
+            ydl.add_progress_hook(self.throttle())
+            ydl.add_progress_hook(self.inform)
+            if self.metrics is not None:
+                ydl.add_progress_hook(self.count_bytes())
+            if info is None:
+                ydl.download([task.url], extra=task.info, ie_key=ie_key)
+            else:
+                # analysed a moment ago, straight to fetching the media
+                ydl.process_ie_result(info, download=True, extra_info=task.info)
+        if ydl.deferred:
+            self.queue.put_many([
+                task.child(task.url, info=task.info, key=task.key, postprocess=deferred)
+                for deferred in ydl.deferred
+            ])
+            self.inform({'status': 'postprocessing', 'ratelimit': None})
+        else:
+            self.inform({'status': 'done', 'ratelimit': None})
+
+    def postprocess(self, task):
+        # the fork server we were started from imported it already
+        from youtube_dl_server.ytdl import YoutubeDL
+        self.inform({'status': 'postprocessing'})
+        print("Starting post processing of " + self.url)
+        ydl_opts = {
+            'quiet': True,
+            'call_home': False,
+            'merge_output_format': 'mp4',
+            # recorded once merged, see `YoutubeDL.record_download_archive`
+            'download_archive': self.archive.path,
+        }
+        started = time.monotonic()
+        try:
+            with YoutubeDL(ydl_opts) as ydl:
+                ydl.run_deferred(task.postprocess)
+        finally:
+            if self.postprocess_stats is not None:
+                with self.postprocess_stats.get_lock():
+                    self.postprocess_stats[0] += 1
+                    self.postprocess_stats[1] += time.monotonic() - started
         self.inform({'status': 'done'})
 
 
@@ -0,0 +1,271 @@
+"""What we change about youtube-dl, only the workers import it.
+
+The fork server they are started from imported it already, see `processes`.
+"""
+from itertools import islice
+import os
+from threading import Lock
+from threading import Thread
+import traceback
+
+import youtube_dl as ydl
+from youtube_dl import postprocessor
+from youtube_dl.downloader import get_suitable_downloader
+from youtube_dl.downloader.common import FileDownloader
+from youtube_dl.utils import format_bytes
+from youtube_dl.utils import PagedList
+from youtube_dl.utils import prepend_extension
+from youtube_dl.utils import UnavailableVideoError
+from youtube_dl import YoutubeDL as YoutubeDL_
+from youtube_dl.extractor import gen_extractor_classes
+
+from youtube_dl_server.archive import video_key
+from youtube_dl_server.utils import attribute
+
+
+def url_key(url):
+    """The video_key of `url` without extracting it, None if no extractor knows it"""
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        try:
+            return video_key(ie.ie_key(), ie._match_id(url))
+        except Exception:
+            return None
+    return None
+
+
+def iter_entries(entries, page_size=50):
+    """The entries of an unprocessed playlist one by one, pages are only fetched once we get to them"""
+    if not isinstance(entries, PagedList):
+        yield from entries
+        return
+    start = 0
+    while True:
+        page = entries.getslice(start, start + page_size)
+        if not page:
+            return
+        yield from page
+        start += len(page)
+
+
+def select_entries(entries, ranges):
+    """The `(index, entry)`s of the playlist `entries` within `ranges`, only the
+    pages holding them are fetched
+    """
+    if isinstance(entries, PagedList):
+        for first, last in ranges.ranges:
+            yield from enumerate(entries.getslice(first - 1, last), first)
+    elif isinstance(entries, list):
+        for first, last in ranges.ranges:
+            yield from enumerate(entries[first - 1:last], first)
+    else:
+        for index, entry in islice(enumerate(entries, 1), ranges.last):
+            if index in ranges:
+                yield index, entry
+
+
+class CombinedProgress:
+    """Reports the progress of downloads running at the same time as one to `hooks`"""
+
+    def __init__(self, hooks, n):
+        self.hooks = hooks
+        self.statuses = [{} for _ in range(n)]
+        self._lock = Lock()
+
+    def hook(self, i):
+        def hook(d):
+            with self._lock:
+                self.statuses[i] = dict(d)
+                self.report(d)
+        return hook
+
+    def report(self, last):
+        statuses = self.statuses
+        downloaded = sum(s.get('downloaded_bytes') or 0 for s in statuses)
+        totals = [s.get('total_bytes') or s.get('total_bytes_estimate') for s in statuses]
+        total = sum(totals) if all(totals) else None
+        speed = sum(s.get('speed') or 0 for s in statuses if s.get('status') == 'downloading')
+        finished = all(s.get('status') == 'finished' for s in statuses)
+        d = {
+            'status': 'finished' if finished else 'downloading',
+            'filename': last.get('filename'),
+            'tmpfilename': last.get('tmpfilename'),
+            'downloaded_bytes': downloaded,
+            'total_bytes': total,
+            'speed': speed or None,
+            'eta': int((total - downloaded) / speed) if total and speed else None,
+        }
+        if total:
+            d['_percent_str'] = FileDownloader.format_percent(100 * downloaded / total)
+            d['_total_bytes_str'] = format_bytes(total)
+        d['_speed_str'] = FileDownloader.format_speed(d['speed'])
+        d['_eta_str'] = FileDownloader.format_eta(d['eta'])
+        for hook in self.hooks:
+            hook(d)
+
+
+class YoutubeDL(YoutubeDL_):
+    def __init__(self, params=None, archive=None, *args, **kwargs):
+        super(YoutubeDL, self).__init__(params, *args, **kwargs)
+        self.archive = archive
+        # post processing left for the postprocess stage
+        self.deferred = []
+        # the video of the post processing we just deferred is recorded by `run_deferred`
+        self._archive_deferred = False
+
+    def process_info(self, info_dict):
+        """With `concurrent_formats` merged formats are fetched at the same time first,
+        youtube-dl then finds them downloaded already and only merges them.
+        """
+        if (self.params.get('concurrent_formats') and
+                len(info_dict.get('requested_formats') or ()) > 1 and
+                not self.params.get('skip_download') and
+                not self.params.get('simulate') and
+                self._match_entry(info_dict, incomplete=False) is None and
+                self.fetch_formats(info_dict)):
+            # the streams would be reported once more as already downloaded
+            with attribute(self, '_progress_hooks', []):
+                return super(YoutubeDL, self).process_info(info_dict)
+        return super(YoutubeDL, self).process_info(info_dict)
+
+    def fetch_formats(self, info_dict):
+        """Download the `requested_formats` each in a thread, returns whether all succeeded"""
+        # named like process_info does, which counts this download before naming it
+        with attribute(self, '_num_downloads', self._num_downloads + 1):
+            filename = self.prepare_filename(info_dict)
+            downloads = []
+            for f in info_dict['requested_formats']:
+                info = dict(info_dict)
+                info.update(f)
+                name = prepend_extension(self.prepare_filename(info), 'f%s' % f['format_id'], info['ext'])
+                downloads.append((name, info))
+        base = os.path.splitext(filename)[0]
+        if any(os.path.exists('{}.{}'.format(base, ext)) for ext in (info_dict['ext'], 'mkv')):
+            # merged before
+            return False
+
+        progress = CombinedProgress(self._progress_hooks, len(downloads))
+        # the running streams share the ratelimit
+        params = [dict(self.params) for _ in downloads]
+
+        def limit(d):
+            rate = self.params.get('ratelimit')
+            running = [p for p, s in zip(params, progress.statuses) if s.get('status') != 'finished']
+            for p in running:
+                p['ratelimit'] = rate and rate / len(running)
+
+        threads = []
+        for i, (name, info) in enumerate(downloads):
+            os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+            fd = get_suitable_downloader(info, params[i])(self, params[i])
+            fd.add_progress_hook(progress.hook(i))
+            fd.add_progress_hook(limit)
+            threads.append(Thread(target=self._fetch, args=(fd, name, info), daemon=True))
+        limit(None)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return all(progress.statuses[i].get('status') == 'finished' for i in range(len(downloads)))
+
+    def _fetch(self, fd, name, info):
+        try:
+            fd.download(name, info)
+        except Exception:
+            # process_info downloads what is missing one after the other
+            traceback.print_exc()
+
+    def post_process(self, filename, ie_info):
+        """With `defer_postprocessing` only remember what the postprocessors would do, see `run_deferred`"""
+        pps = ie_info.get('__postprocessors')
+        # configured ones may need more than a downloader to be created again
+        if not self.params.get('defer_postprocessing') or not pps or self._pps:
+            return super(YoutubeDL, self).post_process(filename, ie_info)
+        self.deferred.append({
+            'filename': filename,
+            'postprocessors': [type(pp).__name__ for pp in pps],
+            'info': {k: v for k, v in ie_info.items() if k != '__postprocessors'},
+        })
+        self._archive_deferred = True
+
+    def record_download_archive(self, info_dict):
+        """process_info records the video right after `post_process`, a deferred one only counts
+        as downloaded once it was merged
+        """
+        if self._archive_deferred:
+            self._archive_deferred = False
+            return
+        super(YoutubeDL, self).record_download_archive(info_dict)
+
+    def run_deferred(self, deferred):
+        info = dict(deferred['info'])
+        info['__postprocessors'] = [getattr(postprocessor, name)(self) for name in deferred['postprocessors']]
+        super(YoutubeDL, self).post_process(deferred['filename'], info)
+        self.record_download_archive(info)
+
+    def process_ie_result(self, ie_result, download=True, extra_info={}):
+        """With `playlist_ranges` only those entries of the playlist are listed.
+
+        youtube-dl's own `playlist_items` expands every number of the ranges
+        and dedupes them in quadratic time, these stay ranges.
+        """
+        ranges = self.params.get('playlist_ranges')
+        if ((ranges is not None or self.params.get('matchtitle')) and 'playlist' not in extra_info and
+                ie_result.get('_type') in ('playlist', 'multi_video')):
+            entries = ie_result['entries']
+            if ranges is not None:
+                entries = select_entries(entries, ranges)
+            else:
+                entries = enumerate(iter_entries(entries), 1)
+            # youtube-dl numbers them by their place in what is left after filtering, keep ours
+            ie_result['entries'] = [dict(entry, playlist_index=index) for index, entry in entries]
+        return super(YoutubeDL, self).process_ie_result(ie_result, download, extra_info)
+
+    def in_download_archive(self, info_dict):
+        """Look it up in our Archive instead of reading the whole file every time"""
+        if self.archive is None:
+            return super(YoutubeDL, self).in_download_archive(info_dict)
+        key = self._make_archive_id(info_dict)
+        return key is not None and key in self.archive
+
+    def unprocessed(self, url, ie_key=None):
+        """What the extractor gives for `url` without resolving anything, following redirects
+        to other extractors. The entries of a playlist are only listed while iterating them.
+        """
+        result = self.extract_info(url, download=False, ie_key=ie_key, process=False)
+        while result.get('_type') in ('url', 'url_transparent'):
+            result = self.extract_info(result['url'], download=False, ie_key=result.get('ie_key'), process=False)
+        return result
+
+    def download(self, url_list, extra=None, ie_key=None):
+        """Download a given list of URLs."""
+        extra = extra or {}
+        outtmpl = self.params.get('outtmpl', ydl.DEFAULT_OUTTMPL)
+        if (len(url_list) > 1 and
+                outtmpl != '-' and
+                '%' not in outtmpl and
+                self.params.get('max_downloads') != 1):
+            raise ydl.SameFileError(outtmpl)
+
+        out = []
+        for url in url_list:
+            try:
+                # It also downloads the videos
+                res = self.extract_info(
+                    url,
+                    ie_key=ie_key,
+                    force_generic_extractor=self.params.get('force_generic_extractor', False),
+                    extra_info=extra,
+                )
+            except UnavailableVideoError:
+                self.report_error('unable to download video')
+                raise
+            except ydl.MaxDownloadsReached:
+                self.to_screen('[info] Maximum number of downloaded files reached.')
+                raise
+            else:
+                if self.params.get('dump_single_json', False):
+                    out.append(res)
+
+        return out